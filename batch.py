@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from census_cache import DEFAULT_CACHE_DIR, MAX_ENTRIES, file_hash, load_day_census
+from evaluation import DEFAULT_PARAMS, POLICIES, day_from_census, evaluate_allocations
+from solver import UNIT_NAMES
+from sweep import grid_points
+
+# Batch runner over a grid of extracted days x parameter sets: every (day, parameter set)
+# runs the allocation policies of evaluation.py and becomes one row per policy of a single
+# NDJSON result table. Rows are appended as soon as they arrive, and a rerun with the same
+# output file skips the (day, parameter set, policy) rows that are already in it, so an
+# interrupted run resumes where it stopped.
+# The workers share the read-only inputs through the census cache: every day (with the Ep_d
+# table aligned to its ICD codes) is compiled once and then memory-mapped by every worker.
+
+
+### name of a day in the result table: its folder name, e.g. EP_20 ###
+def day_name(day_dir):
+    return os.path.basename(os.path.normpath(day_dir))
+
+
+### identity of a parameter set in the result table ###
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+### the (day, parameter set, policy) rows already in a result table ###
+def read_done(path):
+    # a row cut off by an interruption is dropped, so that its task runs again
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as file:
+        data = file.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            file.truncate(end)
+    for line in data[:end].splitlines():
+        if line.strip():
+            row = json.loads(line)
+            done.add((row["day"], row["params_key"], row["policy"]))
+    return done
+
+
+_worker_ep_path = None
+_worker_cache_dir = None
+_worker_cache_size = MAX_ENTRIES
+
+
+def _init_worker(ep_path, cache_dir, cache_size=MAX_ENTRIES):
+    global _worker_ep_path, _worker_cache_dir, _worker_cache_size
+    _worker_ep_path = ep_path
+    _worker_cache_dir = cache_dir
+    _worker_cache_size = cache_size
+    # hashed once per worker, every later lookup is a stat
+    file_hash(ep_path, cache_dir)
+
+
+def _warm_day(day_dir):
+    load_day_census(day_dir, _worker_ep_path, _worker_cache_dir, max_entries=_worker_cache_size)
+
+
+def _run_task(day_dir, param_sets, policies):
+    # one day with a chunk of parameter sets, so the census is loaded once per chunk
+    census = load_day_census(day_dir, _worker_ep_path, _worker_cache_dir, max_entries=_worker_cache_size)
+    name = day_name(day_dir)
+    rows = []
+    for params in param_sets:
+        full = dict(DEFAULT_PARAMS, **params)
+        day = day_from_census(census, name, full)
+        allocations, times = {}, {}
+        for policy in policies:
+            start = time.perf_counter()
+            allocations[policy] = POLICIES[policy](day, full)
+            times[policy] = time.perf_counter() - start
+        report = evaluate_allocations(day["real"], allocations, len(day["values"]), day["values"])
+        for policy, entry in report.items():
+            counts = entry["confusion"].sum(axis=0)
+            row = {"day": name, "params_key": params_key(params), "policy": policy}
+            row.update(params)
+            row.update({"accuracy": entry["accuracy"], "value": entry["value"], "patients": len(day["values"]),
+                        "seconds": times[policy]})
+            row.update({unit: int(counts[i]) for i, unit in enumerate(UNIT_NAMES)})
+            rows.append(row)
+    return rows
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+### run every day x parameter set that is not in the result table yet ###
+def run_batch(day_dirs, ep_path, param_sets, out_path, policies=tuple(POLICIES), workers=None, chunk_size=8,
+              cache_dir=DEFAULT_CACHE_DIR):
+    # param_sets: list of parameter dicts overriding evaluation.DEFAULT_PARAMS, e.g. sweep.grid_points(...)
+    # returns the number of rows written
+    # the rows of a day are keyed by its folder name, so two days must not share one
+    names = {}
+    for day_dir in day_dirs:
+        other = names.setdefault(day_name(day_dir), day_dir)
+        if os.path.normpath(other) != os.path.normpath(day_dir):
+            raise ValueError("days " + other + " and " + day_dir + " have the same name " + day_name(day_dir))
+    workers = workers or os.cpu_count()
+    done = read_done(out_path)
+    tasks = []
+    for day_dir in names.values():
+        name = day_name(day_dir)
+        # parameter sets grouped by the policies they still miss
+        todo = {}
+        for params in param_sets:
+            missing = tuple(p for p in policies if (name, params_key(params), p) not in done)
+            if missing:
+                todo.setdefault(missing, []).append(params)
+        for missing, group in todo.items():
+            tasks += [(day_dir, chunk, missing) for chunk in _chunks(group, chunk_size)]
+    if not tasks:
+        return 0
+    # the cache holds every day of the run, so the warm pass below is not evicted by itself
+    cache_size = max(MAX_ENTRIES, len({task[0] for task in tasks}))
+    written = 0
+    with open(out_path, 'a') as out:
+        def write(rows):
+            for row in rows:
+                out.write(json.dumps(row) + "\n")
+            out.flush()
+            return len(rows)
+
+        if workers == 1:
+            _init_worker(ep_path, cache_dir, cache_size)
+            for task in tasks:
+                written += write(_run_task(*task))
+            return written
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(ep_path, cache_dir, cache_size)) as pool:
+            # compile the missing cache entries first, one per day, instead of in every worker at once
+            list(pool.map(_warm_day, sorted({task[0] for task in tasks})))
+            futures = [pool.submit(_run_task, *task) for task in tasks]
+            for future in as_completed(futures):
+                written += write(future.result())
+    return written
+
+
+### mean accuracy / value of every (policy, parameter set) over the days of a result table ###
+def summarize(path):
+    summary = {}
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            entry = summary.setdefault((row["policy"], row["params_key"]), {"days": 0, "accuracy": 0.0, "value": 0.0})
+            entry["days"] += 1
+            entry["accuracy"] += row["accuracy"]
+            entry["value"] += row["value"]
+    for entry in summary.values():
+        entry["accuracy"] /= entry["days"]
+        entry["value"] /= entry["days"]
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("days", nargs="+", help="extracted day directories, e.g. EP_21")
+    parser.add_argument("--ep", default="epstats.json")
+    parser.add_argument("--param", nargs="+", action="append", default=[], metavar=("NAME", "VALUE"),
+                        help="a grid axis, e.g. --param R_icu 60 77 --param w1 0.3 0.5")
+    parser.add_argument("--grid", default=None, help="JSON file with a list of parameter dicts, instead of --param")
+    parser.add_argument("--policies", nargs="+", default=list(POLICIES), choices=list(POLICIES))
+    parser.add_argument("--out", default="results.ndjson")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    if args.grid:
+        with open(args.grid) as f:
+            param_sets = json.load(f)
+    else:
+        param_sets = grid_points(**{name: [json.loads(o) for o in options] for name, *options in args.param})
+    written = run_batch(args.days, args.ep, param_sets, args.out, args.policies, args.workers, args.chunk_size,
+                        args.cache_dir)
+    print("%d rows written to %s" % (written, args.out))
+    for (policy, key), entry in sorted(summarize(args.out).items()):
+        print("%-6s %s days: %d accuracy: %.4f value: %.2f" % (policy, key, entry["days"], entry["accuracy"],
+                                                               entry["value"]))
@@ -0,0 +1,39 @@
+# Most-deteriorated-first baseline: batch allocation and per-arrival latency of the streaming mode
+# run from the repository root: python -m benchmarks.bench_mdf
+import argparse
+import time
+
+import numpy as np
+
+from mdf import MDFStream, mdf_alloc
+
+SIZES = [100, 1000, 10000, 100000, 1000000]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    args = parser.parse_args()
+
+    print("%10s %12s %12s %18s" % ("patients", "batch (ms)", "tie (ms)", "stream (us/patient)"))
+    for total in args.sizes:
+        rng = np.random.default_rng(total)
+        sofa = rng.integers(0, 25, total)
+        age = rng.integers(18, 91, total)
+        capacities = [total // 10, total // 2]
+
+        start = time.perf_counter()
+        mdf_alloc(sofa, capacities)
+        batch = time.perf_counter() - start
+
+        start = time.perf_counter()
+        mdf_alloc(sofa, capacities, tie_key=-age)
+        tie = time.perf_counter() - start
+
+        stream = MDFStream(capacities)
+        n_stream = min(total, 100000)
+        start = time.perf_counter()
+        for p in range(n_stream):
+            stream.assign(p, sofa[p])
+        per_arrival = (time.perf_counter() - start) / n_stream
+        print("%10d %12.3f %12.3f %18.2f" % (total, batch * 1e3, tie * 1e3, per_arrival * 1e6))
@@ -0,0 +1,50 @@
+# Build time and peak RSS of the allocation LP, sparse builder vs the original lists
+# run from the repository root: python -m benchmarks.bench_model_builder
+import argparse
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+
+from model_builder import build_model, build_dense_model
+
+SIZES = [100, 500, 1000, 5000, 10000, 50000]
+DENSE_MAX = 5000  # the list-of-lists build is O(P^2), stop it early
+
+
+def run_one(args):
+    builder, total = args
+    rng = np.random.default_rng(total)
+    v_icu = rng.random(total)
+    v_noicu = rng.random(total)
+    status = rng.integers(0, 2, total)
+    start = time.perf_counter()
+    build = build_model if builder == "sparse" else build_dense_model
+    model = build(v_icu, v_noicu, status, 77, 600, 0.85, 0, 3, 0.99)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del model
+    return elapsed, rss_after / 1024
+
+
+def measure(builder, total):
+    # a fresh process per measurement, so that the peak RSS is not polluted by earlier sizes
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_one, ((builder, total),))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--dense-max", type=int, default=DENSE_MAX)
+    args = parser.parse_args()
+
+    print("%-8s %10s %12s %14s" % ("builder", "patients", "build (s)", "peak RSS (MB)"))
+    for total in args.sizes:
+        for builder in ("sparse", "dense"):
+            if builder == "dense" and total > args.dense_max:
+                continue
+            elapsed, rss = measure(builder, total)
+            print("%-8s %10d %12.4f %14.1f" % (builder, total, elapsed, rss))
@@ -0,0 +1,47 @@
+# Multi-unit network allocation: exact model vs Lagrangian decomposition, time and optimality gap
+# run from the repository root: python -m benchmarks.bench_network
+import argparse
+import time
+
+import numpy as np
+
+from network import site_costs, solve_network, transfer_costs, unit_values
+
+SIZES = [(1000, 4), (10000, 8), (100000, 16), (1000000, 16)]
+# the exact model is skipped above this many patients x units
+EXACT_LIMIT = 100000
+
+
+def random_network(total, n_units, n_sites=3, seed=0):
+    rng = np.random.default_rng(seed)
+    is_icu = np.arange(n_units) % 2 == 0
+    current = np.where(rng.random(total) < 0.3, rng.integers(0, n_units, total), -1)
+    values = unit_values(rng.uniform(0.5, 1.5, total), rng.uniform(0.3, 1.2, total), is_icu, current)
+    site_transfer = rng.uniform(0, 0.2, (n_sites, n_sites))
+    np.fill_diagonal(site_transfer, 0)
+    costs = transfer_costs(rng.integers(0, n_sites, total), site_costs(np.arange(n_units) % n_sites, site_transfer))
+    capacities = rng.integers(total // (3 * n_units), total // n_units, n_units)
+    return values, capacities, costs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs=2, action="append", default=None, metavar=("PATIENTS", "UNITS"))
+    args = parser.parse_args()
+
+    print("%10s %6s %12s %14s %12s %10s %10s" % ("patients", "units", "exact (s)", "lagrangian (s)", "iterations",
+                                                 "gap (%)", "vs exact (%)"))
+    for total, n_units in args.sizes or SIZES:
+        values, capacities, costs = random_network(total, n_units)
+        exact, exact_time = None, float("nan")
+        if total * n_units <= EXACT_LIMIT:
+            start = time.perf_counter()
+            exact = solve_network(values, capacities, costs, "exact")
+            exact_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = solve_network(values, capacities, costs, "lagrangian")
+        lagrangian_time = time.perf_counter() - start
+        gap = 100 * (result["bound"] - result["objective"]) / abs(result["bound"])
+        loss = 100 * (exact["objective"] - result["objective"]) / abs(exact["objective"]) if exact else float("nan")
+        print("%10d %6d %12.3f %14.3f %12d %10.4f %10.4f" % (total, n_units, exact_time, lagrangian_time,
+                                                             result["iterations"], gap, loss))
@@ -0,0 +1,78 @@
+# Vectorized L_p / V_p engine vs the per-patient calculate_l_p / calculate_v_p of model.ipynb
+# run from the repository root: python -m benchmarks.bench_patient_values
+import argparse
+import random
+import time
+
+import numpy as np
+
+from historical_stat_process import mapping_sofa_to_mortality
+from patient_values import calculate_v_p_all, compile_ep, compile_patients, sofa_mortality_table
+
+SIZES = [10000, 100000, 1000000]
+W1, W2 = 0.5, 0.8
+
+
+### the scalar functions of model.ipynb, with w1 / w2 passed explicitly ###
+def calculate_l_p(data, patient_id, Ep_d, noicu_flag=0):
+    weights = 0
+    for diag in data[patient_id]["icd_code"]:
+        weights += 1/int(data[patient_id]["icd_code"][diag])
+    sum = 0
+    for diag in data[patient_id]["icd_code"]:
+        try:
+            sum += (1 / weights) * (1 / int(data[patient_id]["icd_code"][diag])) * Ep_d[diag][noicu_flag]
+        except KeyError:
+            sum += 0
+    l_p = min(1 - mapping_sofa_to_mortality(data[patient_id]["SOFA"]) + sum, 1)
+    l_p = max(0, l_p)
+    return l_p
+
+
+def calculate_v_p(data, patient_id, Ep_d, noicu_flag):
+    l_p = calculate_l_p(data, patient_id, Ep_d, noicu_flag)
+    return W1 * l_p + W2 * int(data[patient_id]["age"]) / 100
+
+
+def random_census(total, n_codes=5000, seed=0):
+    rng = random.Random(seed)
+    codes = [str(c) for c in range(n_codes)]
+    data = {}
+    for sid in range(total):
+        n_diag = rng.randint(1, 15)
+        data[str(sid)] = {
+            "status": rng.randint(0, 1),
+            "icd_code": {code: str(rng.randint(1, 39)) for code in rng.sample(codes, n_diag)},
+            "age": rng.randint(18, 91),
+            "SOFA": rng.randint(0, 24),
+        }
+    # a few codes have no statistics, like in a real census
+    Ep_d = {code: [rng.uniform(-0.3, 0.3), rng.uniform(-0.3, 0.3)] for code in codes[:int(0.9 * n_codes)]}
+    return data, Ep_d
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    args = parser.parse_args()
+
+    print("%10s %12s %12s %12s %10s %12s" % ("patients", "scalar (s)", "compile (s)", "values (s)", "speedup", "max |diff|"))
+    for total in args.sizes:
+        data, Ep_d = random_census(total)
+        sids = list(data)
+
+        start = time.perf_counter()
+        scalar = np.array([[calculate_v_p(data, sid, Ep_d, 0), calculate_v_p(data, sid, Ep_d, 1)] for sid in sids])
+        scalar_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        compiled = compile_patients(data, sids)
+        ep_table = compile_ep(Ep_d, compiled["icd_codes"])
+        compile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vector = calculate_v_p_all(compiled, ep_table, W1, W2, sofa_mortality_table())
+        vector_time = time.perf_counter() - start
+
+        print("%10d %12.3f %12.3f %12.4f %9.0fx %12.2e" % (
+            total, scalar_time, compile_time, vector_time, scalar_time / vector_time, np.abs(scalar - vector).max()))
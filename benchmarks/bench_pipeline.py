@@ -0,0 +1,122 @@
+# End-to-end scaling benchmark on synthetic MIMIC-shaped data (synthetic.py): time and peak
+# memory of every pipeline stage, from 10^2 to 10^6 census patients
+# run from the repository root: python -m benchmarks.bench_pipeline
+# every run is appended to --history (one JSON line per size, with the commit), and with
+# --baseline the stages that got slower than --threshold x the baseline fail the run
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import profiling
+from census_cache import load_census
+from evaluation import DEFAULT_PARAMS, day_from_census, lp_policy, mdf_policy
+from historical_stat_process import calculate_hist_stats_parallel
+from process import process_stream
+from synthetic import write_census, write_history
+
+SIZES = [100, 1000, 10000, 100000, 1000000]
+# the allocation model is solved up to this many patients
+SOLVE_LIMIT = 100000
+# stages shorter than this are too noisy to compare against a baseline
+MIN_SECONDS = 0.05
+
+
+def run_size(total, workdir, solve_limit=SOLVE_LIMIT, time_limit=60):
+    # census of total patients (10% incoming), history of total patients
+    profiling.enable(sample_interval=0.01, patients=total)
+    day_dir = os.path.join(workdir, "EP_%d" % total)
+    hist_path = os.path.join(workdir, "historical_%d.json" % total)
+    ep_path = os.path.join(workdir, "epstats_%d.json" % total)
+    with profiling.stage("generate"):
+        write_census(day_dir, total // 10, total - total // 10)
+        write_history(hist_path, total)
+    process_stream(0, os.path.join(day_dir, "incoming.json"), os.path.join(day_dir, "newindata.ndjson"))
+    process_stream(1, os.path.join(day_dir, "existing.json"), os.path.join(day_dir, "newexdata.ndjson"))
+    with profiling.stage("historical"):
+        calculate_hist_stats_parallel(hist_path, ep_path)
+    paths = [os.path.join(day_dir, "newindata.ndjson"), os.path.join(day_dir, "newexdata.ndjson"), ep_path]
+    cache_dir = os.path.join(workdir, "cache")
+    with profiling.stage("load_census_cold"):
+        load_census(*paths, cache_dir=cache_dir)
+    with profiling.stage("load_census_warm"):
+        census = load_census(*paths, cache_dir=cache_dir)
+    params = dict(DEFAULT_PARAMS, R_icu=int(0.15 * total) + 1, R_noicu=total, time_limit=time_limit)
+    day = day_from_census(census, "EP_%d" % total, params)
+    with profiling.stage("mdf"):
+        mdf_policy(day, params)
+    if len(day["values"]) <= solve_limit:
+        with profiling.stage("lp"):
+            lp_policy(day, params)
+    run = profiling.report()
+    profiling.disable()
+    return run
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+### stages slower than threshold x the baseline run of the same size ###
+def regressions(run, baseline, threshold):
+    slower = []
+    for path, entry in run["stages"].items():
+        base = baseline["stages"].get(path)
+        if base and base["seconds"] >= MIN_SECONDS and entry["seconds"] > threshold * base["seconds"]:
+            slower.append((path, base["seconds"], entry["seconds"]))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--solve-limit", type=int, default=SOLVE_LIMIT)
+    # the default history is in .bench_history/, which git ignores
+    parser.add_argument("--history", default=os.path.join(".bench_history", "bench_pipeline.ndjson"),
+                        help="append the results of this run here")
+    parser.add_argument("--baseline", default=None, help="a --history file to compare against (latest run per size)")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            for line in f:
+                if line.strip():
+                    run = json.loads(line)
+                    baseline[run["meta"]["patients"]] = run
+    commit = _commit()
+    failed = False
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+    with tempfile.TemporaryDirectory() as workdir:
+        for total in args.sizes:
+            # a fresh process per size, so that the peak memory of a size is its own
+            with ProcessPoolExecutor(1) as pool:
+                run = pool.submit(run_size, total, workdir, args.solve_limit).result()
+            run["meta"].update(commit=commit, python=sys.version.split()[0], numpy=np.__version__)
+            with open(args.history, 'a') as f:
+                f.write(json.dumps(run) + "\n")
+            print("%d patients: %.2f s, peak memory %.1f MB" % (total, run["wall_seconds"], run["peak_rss_mb"]))
+            for path, entry in run["stages"].items():
+                print("    %-36s %10.3f s %10.1f MB" % (path, entry["seconds"], entry["peak_rss_mb"]))
+            for path, before, after in regressions(run, baseline[total], args.threshold) if total in baseline else []:
+                failed = True
+                print("    REGRESSION %s: %.3f s -> %.3f s" % (path, before, after))
+            # the files of a size are not needed any more
+            for name in os.listdir(workdir):
+                path = os.path.join(workdir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+    sys.exit(1 if failed else 0)
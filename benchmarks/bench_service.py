@@ -0,0 +1,83 @@
+# Online allocation service: decision latency of admit / SOFA update / discharge events sent by
+# concurrent local clients over a Unix socket, on censuses of growing size
+# run from the repository root: python -m benchmarks.bench_service
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_patient_values import random_census
+from service import AllocationClient, AllocationService
+
+SIZES = [1000, 5000, 20000]
+
+
+async def run(total, events, clients, deadline):
+    data, Ep_d = random_census(total + events, n_codes=5000)
+    sids = list(data)
+    census = {sid: data[sid] for sid in sids[:total]}
+    arrivals = sids[total:]
+    # about 15% of the census fits in ICU, the rest in the general wards
+    service = AllocationService(Ep_d, {"R_icu": int(0.15 * total / 0.85), "R_noicu": total}, deadline)
+    path = os.path.join(tempfile.mkdtemp(), "alloc.sock")
+    server = asyncio.create_task(service.serve(path=path))
+    while not os.path.exists(path):
+        await asyncio.sleep(0.01)
+    loader = await AllocationClient.connect(path=path)
+    start = time.perf_counter()
+    await loader.request("load", patients=census)
+    load_time = time.perf_counter() - start
+    await loader.close()
+
+    rng = random.Random(total)
+    admitted = list(census)
+    latencies = []
+    errors = []
+
+    async def client(arrivals):
+        conn = await AllocationClient.connect(path=path)
+        for sid in arrivals:
+            kind = rng.random()
+            start = time.perf_counter()
+            if kind < 0.5:
+                answer = await conn.request("admit", id=sid, patient=data[sid])
+                admitted.append(sid)
+            elif kind < 0.8:
+                answer = await conn.request("sofa", id=rng.choice(admitted), sofa=rng.randint(0, 24))
+            else:
+                victim = admitted.pop(rng.randrange(len(admitted)))
+                answer = await conn.request("discharge", id=victim)
+            latencies.append(time.perf_counter() - start)
+            if not answer["ok"]:
+                errors.append(answer["error"])
+        await conn.close()
+
+    await asyncio.gather(*[client(arrivals[i::clients]) for i in range(clients)])
+    stats = service.stats()
+    server.cancel()
+    return load_time, np.array(latencies), stats, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--deadline", type=float, default=0.05)
+    args = parser.parse_args()
+
+    print("%10s %10s %10s %10s %10s %10s %8s %8s %8s" % ("patients", "load (s)", "p50 (ms)", "p99 (ms)", "max (ms)",
+                                                         "events/s", "lp", "mdf", "errors"))
+    for total in args.sizes:
+        start = time.perf_counter()
+        load_time, latencies, stats, errors = asyncio.run(run(total, args.events, args.clients, args.deadline))
+        elapsed = time.perf_counter() - start - load_time
+        print("%10d %10.2f %10.2f %10.2f %10.2f %10.0f %8d %8d %8d" % (
+            total, load_time, np.percentile(latencies, 50) * 1e3, np.percentile(latencies, 99) * 1e3,
+            latencies.max() * 1e3, len(latencies) / elapsed, stats["lp"], stats["mdf"], len(errors)))
+        for error in sorted(set(errors))[:5]:
+            print("    " + error)
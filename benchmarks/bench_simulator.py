@@ -0,0 +1,49 @@
+# Replay of a synthetic year of arrivals under a grid of scenarios
+# run from the repository root: python -m benchmarks.bench_simulator
+import argparse
+import random
+import time
+
+from simulator import compile_arrivals, run_scenarios, simulate
+from sweep import grid_points
+
+
+def random_arrivals(days, per_day, n_codes=2000, seed=0):
+    rng = random.Random(seed)
+    codes = [str(c) for c in range(n_codes)]
+    arrivals = {}
+    for i in range(days * per_day):
+        arrivals[str(i)] = {
+            "status": 0,
+            "icd_code": {code: str(rng.randint(1, 39)) for code in rng.sample(codes, rng.randint(1, 15))},
+            "age": rng.randint(18, 91),
+            "SOFA": rng.randint(0, 24),
+            "arrival_day": i // per_day,
+            "los": rng.expovariate(1 / 3),
+        }
+    Ep_d = {code: [rng.uniform(-0.3, 0.3), rng.uniform(-0.3, 0.3)] for code in codes}
+    return arrivals, Ep_d
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--per-day", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    arrivals, Ep_d = random_arrivals(args.days, args.per_day)
+    compiled = compile_arrivals(arrivals, Ep_d)
+    for policy in ("mdf", "lp"):
+        start = time.perf_counter()
+        simulate(compiled, {"policy": policy, "R_icu": 100, "R_noicu": 30})
+        print("%s: one scenario of %d days in %.2f s" % (policy, args.days, time.perf_counter() - start))
+
+    scenarios = grid_points(policy=["mdf", "lp"], R_icu=[80, 100, 120], t=[0, 1])
+    start = time.perf_counter()
+    results = run_scenarios(arrivals, Ep_d, scenarios, args.workers)
+    print("%d scenarios in %.2f s" % (len(scenarios), time.perf_counter() - start))
+    print("%-6s %6s %3s %12s %12s %10s %12s" % ("policy", "R_icu", "t", "utilisation", "waitlist", "rejected", "survival"))
+    for r in results:
+        print("%-6s %6d %3d %12.3f %12.2f %10d %12.1f" % (
+            r["policy"], r["R_icu"], r["t"], r["mean_utilisation"], r["mean_waitlist"], r["rejected"], r["expected_survival"]))
@@ -0,0 +1,54 @@
+# Integer solve with milp vs the linprog methods used so far
+# run from the repository root: python -m benchmarks.bench_solver
+import argparse
+import time
+
+import numpy as np
+
+from model_builder import build_model
+from solver import extract_allocation, solve_allocation
+
+# the legacy dense methods only exist in SciPy < 1.11 and take dense input
+SOLVERS = [
+    ("milp", {}),
+    ("milp", {"mip_rel_gap": 1e-2}),
+    ("milp", {"time_limit": 1.0}),
+    ("linprog", {"method": "highs-ds"}),
+    ("linprog", {"method": "highs-ipm"}),
+    ("linprog", {"method": "simplex"}),
+    ("linprog", {"method": "revised simplex"}),
+]
+DENSE_METHODS = ("simplex", "revised simplex")
+DENSE_MAX = 500
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, nargs="+", default=[100, 500, 2000, 10000])
+    args = parser.parse_args()
+
+    print("%10s %-38s %10s %14s %8s" % ("patients", "solver", "time (s)", "objective", "errors"))
+    for total in args.patients:
+        rng = np.random.default_rng(total)
+        v_icu = rng.random(total)
+        v_noicu = rng.random(total)
+        status = rng.integers(0, 2, total)
+        model = build_model(v_icu, v_noicu, status, 77, 600, 0.85, 3, 3, 0.99)
+        for backend, options in SOLVERS:
+            name = backend + " " + str(options)
+            run_model = model
+            if options.get("method") in DENSE_METHODS:
+                if total > DENSE_MAX:
+                    continue
+                run_model = dict(model, A_ub=model["A_ub"].toarray(), A_eq=model["A_eq"].toarray())
+            start = time.perf_counter()
+            try:
+                result = solve_allocation(run_model, backend, **options)
+            except ValueError as e:
+                print("%10d %-38s %s" % (total, name, e))
+                continue
+            elapsed = time.perf_counter() - start
+            # fractional patients of the LP relaxation end up as allocation errors
+            errors = len(extract_allocation(result.x)["allocation error"]) if result.x is not None else total
+            fun = np.nan if result.fun is None else result.fun
+            print("%10d %-38s %10.3f %14.4f %8d" % (total, name, elapsed, fun, errors))
@@ -0,0 +1,45 @@
+# Cost of a parameter sweep: warm-started patching vs rebuilding and re-solving every point
+# run from the repository root: python -m benchmarks.bench_sweep
+import argparse
+import time
+
+import numpy as np
+from scipy.optimize import linprog
+
+from model_builder import build_model
+from sweep import grid_points, parametric_sweep, waitlist_points
+
+BASE = {"R_icu": 77, "R_noicu": 600, "Umax": 0.85, "wl_len": 0, "WL_step": 3, "ew": 0.99}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, nargs="+", default=[500, 2000, 5000])
+    args = parser.parse_args()
+
+    points = waitlist_points(30, 3) + grid_points(Umax=[0.7, 0.8, 0.9], ew=[0.5, 0.9, 0.99])
+    print("%d points per sweep" % len(points))
+    print("%10s %12s %12s %12s %14s" % ("patients", "rebuild (s)", "cold (s)", "warm (s)", "single (s)"))
+    for total in args.patients:
+        rng = np.random.default_rng(total)
+        v_icu = rng.random(total)
+        v_noicu = rng.random(total)
+        status = rng.integers(0, 2, total)
+
+        start = time.perf_counter()
+        for point in points:
+            linprog(**build_model(v_icu, v_noicu, status, **dict(BASE, **point)), method="highs-ds")
+        rebuild = time.perf_counter() - start
+
+        start = time.perf_counter()
+        list(parametric_sweep(v_icu, v_noicu, status, BASE, points, warm_start=False))
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        list(parametric_sweep(v_icu, v_noicu, status, BASE, points))
+        warm = time.perf_counter() - start
+
+        start = time.perf_counter()
+        linprog(**build_model(v_icu, v_noicu, status, **BASE), method="highs-ds")
+        single = time.perf_counter() - start
+        print("%10d %12.3f %12.3f %12.3f %14.3f" % (total, rebuild, cold, warm, single))
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from patient_values import compile_ep, compile_patients
+from process import load_ndjson
+
+# Cache of the preprocessed census of an extracted day: the patients of newindata.json and
+# newexdata.json (or their .ndjson versions) compiled by patient_values.compile_patients, the
+# real allocation and the Ep_d table of epstats.json aligned with the census ICD codes.
+# Every array is a .npy file, loaded memory-mapped; an entry is keyed by the SHA-256 of the
+# source files, so editing any of them makes a new entry and the stale one is never read.
+
+DEFAULT_CACHE_DIR = ".census_cache"
+# entries kept when a new one is written, the least recently used go first
+MAX_ENTRIES = 32
+# attempts to read an entry that other processes keep pruning, before compiling without the cache
+LOAD_ATTEMPTS = 3
+# real allocation ("result") codes
+RESULT_CODES = {"ICU": 0, "INPATIENT": 1}
+# the hashes of unchanged files (same size and mtime) are not recomputed
+HASH_INDEX = "hashes.json"
+
+
+def file_hash(path, cache_dir=DEFAULT_CACHE_DIR):
+    stat = os.stat(path)
+    index_path = os.path.join(cache_dir, HASH_INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            index = json.load(file)
+    key = os.path.abspath(path)
+    if key in index and index[key][:2] == [stat.st_size, stat.st_mtime_ns]:
+        return index[key][2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    index[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, prefix=".tmp", delete=False) as file:
+        json.dump(index, file)
+    os.replace(file.name, index_path)
+    return digest.hexdigest()
+
+
+def _load_census_file(path):
+    if path.endswith(".ndjson"):
+        return load_ndjson(path)
+    with open(path) as file:
+        return json.load(file)
+
+
+### compile the sources into arrays, the way model.ipynb merges them into alldata ###
+def build_census(in_path, ex_path, ep_path):
+    alldata = {}
+    for path in (in_path, ex_path):
+        alldata.update(_load_census_file(path))
+    with open(ep_path) as file:
+        Ep_d_list = json.load(file)
+    compiled = compile_patients(alldata)
+    compiled["result"] = np.array([RESULT_CODES.get(patient.get("result"), -1) for patient in alldata.values()],
+                                  dtype=np.int8)
+    compiled["ep_table"] = compile_ep(Ep_d_list, compiled["icd_codes"])
+    return compiled
+
+
+def _prune(cache_dir, keep, current):
+    # several processes may prune at once: entries removed by another one are skipped, and
+    # current (the entry just written) is never removed
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(".") or path == current:
+            continue
+        try:
+            if os.path.isdir(path):
+                entries.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            continue
+    entries.sort(reverse=True)
+    for _, entry in entries[max(keep - 1, 0):]:
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def _write_entry(entry, compiled, cache_dir):
+    # written to a temporary directory first, so that a half-written entry is never read
+    tmp = tempfile.mkdtemp(prefix=".tmp", dir=cache_dir)
+    for name, array in compiled.items():
+        np.save(os.path.join(tmp, name + ".npy"), array)
+    try:
+        os.rename(tmp, entry)
+    except OSError:  # another process wrote the same entry in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+### the compiled census, from the cache when the sources have not changed ###
+def load_census(in_path, ex_path, ep_path, cache_dir=DEFAULT_CACHE_DIR, mmap=True, max_entries=MAX_ENTRIES):
+    # max_entries: size of the cache after a new entry is written, None never prunes
+    key = hashlib.sha256("".join(file_hash(p, cache_dir) for p in (in_path, ex_path, ep_path)).encode()).hexdigest()
+    entry = os.path.join(cache_dir, key)
+    for _ in range(LOAD_ATTEMPTS):
+        if not os.path.isdir(entry):
+            _write_entry(entry, build_census(in_path, ex_path, ep_path), cache_dir)
+            if max_entries is not None:
+                _prune(cache_dir, max_entries, entry)
+        try:
+            # most recently used entries survive pruning
+            os.utime(entry)
+            return {name[:-4]: np.load(os.path.join(entry, name), mmap_mode='r' if mmap else None)
+                    for name in os.listdir(entry) if name.endswith(".npy")}
+        except FileNotFoundError:
+            # pruned by another process in the meantime, the entry is written again
+            continue
+    return build_census(in_path, ex_path, ep_path)
+
+
+### load_census on the files of one extracted day directory (EP_21/ etc.) ###
+def load_day_census(day_dir, ep_path, cache_dir=DEFAULT_CACHE_DIR, mmap=True, max_entries=MAX_ENTRIES):
+    paths = []
+    for name in ("newindata", "newexdata"):
+        path = os.path.join(day_dir, name + ".json")
+        paths.append(path if os.path.exists(path) else os.path.join(day_dir, name + ".ndjson"))
+    return load_census(paths[0], paths[1], ep_path, cache_dir, mmap, max_entries)
@@ -0,0 +1,169 @@
+import argparse
+import json
+import sqlite3
+from datetime import date
+
+from historical_stat_process import accumulate_patient, ep_from_stats, iter_hist_patients
+
+# persistent store of the raw Ep_d accumulators, so that epstats.json does not have to be
+# rebuilt from the full history: every batch of discharges is folded into per
+# (icd_code, unit, day) rows of [count, deaths, sum mortality_by_sofa], and every
+# subject_id is counted once: re-ingesting the batch of a day skips the patients it already
+# added, and a patient already stored with the batch of another day is an error, since its
+# records cannot be merged into the counts after the fact
+
+UNITS = ("ICU", "INPATIENT")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hist_stats (
+    icd_code TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    day TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    deaths INTEGER NOT NULL,
+    mortality_sum REAL NOT NULL,
+    PRIMARY KEY (icd_code, unit, day)
+);
+CREATE TABLE IF NOT EXISTS seen_subjects (
+    subject_id TEXT PRIMARY KEY,
+    day TEXT NOT NULL
+);
+"""
+
+UPSERT = """
+INSERT INTO hist_stats (icd_code, unit, day, count, deaths, mortality_sum) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (icd_code, unit, day) DO UPDATE SET
+    count = count + excluded.count,
+    deaths = deaths + excluded.deaths,
+    mortality_sum = mortality_sum + excluded.mortality_sum
+"""
+
+
+def open_store(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _flush(conn, day, diagnosis_icu, diagnosis_inpatient, subjects):
+    for unit, diagnosis in zip(UNITS, (diagnosis_icu, diagnosis_inpatient)):
+        conn.executemany(UPSERT, ((d, unit, day, v[0], v[1], v[2]) for d, v in diagnosis.items()))
+    conn.executemany("INSERT INTO seen_subjects (subject_id, day) VALUES (?, ?)", ((sid, day) for sid in subjects))
+
+
+### fold a batch of historical query records (historical.json format) into the store ###
+def ingest_records(conn, records, day, batch_size=10000):
+    # day: discharge day of the batch (YYYY-MM-DD), used by the time-windowed and decayed views
+    # records must be ordered by subject_id, like the query output; patients that are
+    # already in the store with the same day are skipped, so re-ingesting a batch is a no-op,
+    # and a patient stored with another day raises ValueError (nothing of the batch is stored)
+    n_new = 0
+    diagnosis_icu, diagnosis_inpatient, subjects = {}, {}, set()
+    with conn:
+        for sid, patient_data in iter_hist_patients(records):
+            sid = str(sid)
+            if sid in subjects:
+                continue
+            seen = conn.execute("SELECT day FROM seen_subjects WHERE subject_id = ?", (sid,)).fetchone()
+            if seen is not None:
+                if seen[0] != day:
+                    raise ValueError("subject_id " + sid + " is already stored with the batch of " + seen[0]
+                                     + ", the records of a patient must be in one batch")
+                continue
+            accumulate_patient(diagnosis_icu, diagnosis_inpatient, patient_data)
+            subjects.add(sid)
+            n_new += 1
+            if len(subjects) >= batch_size:
+                _flush(conn, day, diagnosis_icu, diagnosis_inpatient, subjects)
+                diagnosis_icu, diagnosis_inpatient, subjects = {}, {}, set()
+        _flush(conn, day, diagnosis_icu, diagnosis_inpatient, subjects)
+    return n_new
+
+
+def ingest_file(conn, path, day, batch_size=10000):
+    with open(path) as file:
+        records = (json.loads(line) for line in file if line.strip())
+        return ingest_records(conn, records, day, batch_size)
+
+
+def decay_weight(age, half_life_days):
+    # age in days, a negative age (a batch after as_of) counts as 0
+    return 0.5 ** (max(age, 0) / half_life_days)
+
+
+### Ep_d table (epstats.json format) from the store ###
+def load_ep(conn, icd_codes=None, since=None, until=None, half_life_days=None, as_of=None):
+    # icd_codes: only load these codes, e.g. the ones present in the current census
+    # since / until: only use the batches discharged in [since, until]
+    # half_life_days: weight every batch by 0.5 ** (age in days / half_life_days), where the
+    # age is counted from as_of (default: today); batches after as_of are left out, so every
+    # weight is in (0, 1]
+    where = []
+    params = []
+    weight = "1.0"
+    if since is not None:
+        where.append("s.day >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("s.day <= ?")
+        params.append(until)
+    if half_life_days is not None:
+        if half_life_days <= 0:
+            raise ValueError("half_life_days must be positive")
+        as_of = as_of or date.today().isoformat()
+        conn.create_function("decay", 1, lambda age: decay_weight(age, half_life_days), deterministic=True)
+        weight = "decay(julianday(?) - julianday(s.day))"
+        where.append("s.day <= ?")
+        params.append(as_of)
+    join = ""
+    if icd_codes is not None:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted_codes (icd_code TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM wanted_codes")
+        conn.executemany("INSERT OR IGNORE INTO wanted_codes VALUES (?)", ((str(d),) for d in icd_codes))
+        join = "JOIN wanted_codes w ON (w.icd_code = s.icd_code)"
+    query = ("SELECT s.icd_code, s.unit, SUM({w} * s.count), SUM({w} * s.deaths), SUM({w} * s.mortality_sum) "
+             "FROM hist_stats s {join} {where} GROUP BY s.icd_code, s.unit").format(
+        w=weight, join=join, where=("WHERE " + " AND ".join(where)) if where else "")
+    # the decay weight appears 3 times in the query
+    if half_life_days is not None:
+        params = [as_of] * 3 + params
+    diagnosis_icu, diagnosis_inpatient = {}, {}
+    for icd_code, unit, count, deaths, mortality_sum in conn.execute(query, params):
+        if count > 0:
+            diagnosis = diagnosis_icu if unit == "ICU" else diagnosis_inpatient
+            diagnosis[icd_code] = [count, deaths, mortality_sum]
+    return ep_from_stats(diagnosis_icu, diagnosis_inpatient)
+
+
+### Ep_d of the diagnoses present in a census dict (newindata.json / newexdata.json format) ###
+def load_ep_for_census(conn, data, **view):
+    icd_codes = set()
+    for patient in data.values():
+        icd_codes.update(patient["icd_code"])
+    return load_ep(conn, icd_codes, **view)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default="epstats.sqlite")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("ingest", help="fold a historical query output into the store")
+    ingest.add_argument("path")
+    ingest.add_argument("--day", required=True, help="discharge day of the batch, YYYY-MM-DD")
+    export = commands.add_parser("export", help="write the Ep_d table in epstats.json format")
+    export.add_argument("path", nargs="?", default="epstats.json")
+    export.add_argument("--since")
+    export.add_argument("--until")
+    export.add_argument("--half-life-days", type=float)
+    export.add_argument("--as-of")
+    args = parser.parse_args()
+
+    conn = open_store(args.db)
+    if args.command == "ingest":
+        print("new patients:", ingest_file(conn, args.path, args.day))
+    else:
+        ep_icu_noicu = load_ep(conn, since=args.since, until=args.until,
+                               half_life_days=args.half_life_days, as_of=args.as_of)
+        with open(args.path, 'w') as f:
+            json.dump(ep_icu_noicu, f, ensure_ascii=False, indent=4)
+    conn.close()
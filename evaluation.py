@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import profiling
+from mdf import mdf_alloc_lists
+from census_cache import DEFAULT_CACHE_DIR, RESULT_CODES, load_day_census
+from model_builder import DEFAULT_PARAMS as MODEL_PARAMS
+from model_builder import ICU, INPATIENT, N_UNITS, REJECT, WAITLIST, build_model
+from patient_values import MORTALITY_MAPPINGS, calculate_v_p_all, sofa_mortality_table, take_patients
+from solver import UNIT_NAMES, extract_allocation, solve_allocation
+
+# Comparison of allocation results against the real allocation of an extracted day.
+# Allocations are turned into one unit label per patient, so that membership tests are
+# array lookups instead of `i in list` scans; the labels are 0..3 for ICU / INPATIENT /
+# WAITLIST / REJECT (see model_builder.py) and UNALLOCATED for patients a result does not
+# mention (e.g. "allocation error").
+
+UNALLOCATED = N_UNITS
+N_LABELS = N_UNITS + 1
+LABEL_NAMES = UNIT_NAMES + ["unallocated"]
+# the list form returned by real_alloc / mdf_alloc in model.ipynb: [icu, inpatient, rejected]
+LIST_UNITS = (ICU, INPATIENT, REJECT)
+
+DEFAULT_PARAMS = dict(
+    MODEL_PARAMS,
+    time_limit=10,
+    # M(S) of V_p, a name of patient_values.MORTALITY_MAPPINGS; "notebook" gives the values of model.ipynb
+    mortality="historical",
+)
+
+
+### unit label of every patient from an allocation, in list or dict form ###
+def allocation_labels(allocation, total, merge_waitlist=True):
+    # merge_waitlist: count waitlisted patients as general inpatients, like model.ipynb does
+    labels = np.full(total, UNALLOCATED, dtype=np.int64)
+    if isinstance(allocation, dict):
+        for unit, name in enumerate(UNIT_NAMES):
+            labels[np.asarray(allocation.get(name, []), dtype=np.int64)] = unit
+    else:
+        for unit, members in zip(LIST_UNITS, allocation):
+            labels[np.asarray(members, dtype=np.int64)] = unit
+    if merge_waitlist:
+        labels[labels == WAITLIST] = INPATIENT
+    return labels
+
+
+### confusion matrix, rows are the real labels and columns the calculated ones ###
+def confusion_matrix(real, calculated):
+    return np.bincount(real * N_LABELS + calculated, minlength=N_LABELS * N_LABELS).reshape(N_LABELS, N_LABELS)
+
+
+### the accuracy of cal_accuracy in model.ipynb, from a confusion matrix ###
+def accuracy(cm):
+    # share of the real ICU / inpatient patients that got the same unit
+    total = cm[ICU].sum() + cm[INPATIENT].sum()
+    return float((cm[ICU, ICU] + cm[INPATIENT, INPATIENT]) / total) if total else float("nan")
+
+
+def unit_metrics(cm):
+    metrics = {}
+    for unit in range(N_UNITS):
+        predicted = cm[:, unit].sum()
+        actual = cm[unit].sum()
+        metrics[UNIT_NAMES[unit]] = {
+            "precision": float(cm[unit, unit] / predicted) if predicted else float("nan"),
+            "recall": float(cm[unit, unit] / actual) if actual else float("nan"),
+            "support": int(actual),
+        }
+    return metrics
+
+
+### total V_p of an allocation: V_ICU in ICU, V_non-ICU in general / waitlist, 0 when rejected ###
+def allocation_value(labels, values):
+    icu = labels == ICU
+    noicu = (labels == INPATIENT) | (labels == WAITLIST)
+    return float(values[icu, 0].sum() + values[noicu, 1].sum())
+
+
+### compare any number of allocations against the real one ###
+def evaluate_allocations(real, allocations, total, values=None):
+    # real / allocations: list or dict form, allocations is a dict name -> allocation
+    # values: optional (total, 2) array of V_p, for the expected-value totals
+    real_labels = allocation_labels(real, total)
+    report = {}
+    for name, allocation in allocations.items():
+        labels = allocation_labels(allocation, total)
+        cm = confusion_matrix(real_labels, labels)
+        report[name] = {"confusion": cm, "accuracy": accuracy(cm), "units": unit_metrics(cm)}
+        if values is not None:
+            report[name]["value"] = allocation_value(labels, values)
+    return report
+
+
+### add up the reports of several days ###
+def aggregate_reports(reports):
+    total = {}
+    for report in reports:
+        for name, entry in report.items():
+            if name not in total:
+                total[name] = {"confusion": np.zeros((N_LABELS, N_LABELS), dtype=np.int64), "value": 0.0, "days": 0}
+            total[name]["confusion"] += entry["confusion"]
+            total[name]["value"] += entry.get("value", 0.0)
+            total[name]["days"] += 1
+    for entry in total.values():
+        entry["accuracy"] = accuracy(entry["confusion"])
+        entry["units"] = unit_metrics(entry["confusion"])
+    return total
+
+
+### one extracted day (EP_21/ etc.), loaded the way model.ipynb does (up to params["mortality"]) ###
+def load_day(day_dir, ep_path, params=None, cache_dir=DEFAULT_CACHE_DIR):
+    # the census comes from the binary cache of census_cache.py, rebuilt when a source changes
+    with profiling.stage("load_census"):
+        census = load_day_census(day_dir, ep_path, cache_dir)
+    return day_from_census(census, os.path.basename(os.path.normpath(day_dir)), params)
+
+
+def day_from_census(census, name, params=None):
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    # existing patients already in general inpatient units (status 2) are not allocated
+    compiled = take_patients(census, census["status"] != 2)
+    values = calculate_v_p_all(compiled, compiled["ep_table"], params["w1"], params["w2"],
+                              sofa_mortality_table(params["mortality"]))
+    real = [np.flatnonzero(compiled["result"] == RESULT_CODES["ICU"]),
+            np.flatnonzero(compiled["result"] == RESULT_CODES["INPATIENT"])]
+    return {
+        "day": name,
+        "compiled": compiled,
+        "values": values,
+        "real": real,
+        # general beds taken by the status 2 patients
+        "R_noicu": max(params["R_noicu"] - len(census["sids"]) + len(compiled["sids"]), 0),
+    }
+
+
+### built-in policies: day -> allocation ###
+def mdf_policy(day, params):
+    # most deteriorated first, the highest SOFA scores get the ICU beds, then the general beds
+    return mdf_alloc_lists(day["compiled"]["sofa"], params["R_icu"] * params["Umax"], day["R_noicu"])
+
+
+def lp_policy(day, params):
+    values = day["values"]
+    model = build_model(values[:, 0], values[:, 1], day["compiled"]["status"], params["R_icu"], day["R_noicu"],
+                        params["Umax"], params["wl_len"], params["WL_step"], params["ew"])
+    result = solve_allocation(model, "milp", time_limit=params["time_limit"])
+    return extract_allocation(result.x)
+
+
+POLICIES = {
+    "mdf": mdf_policy,
+    "lp": lp_policy,
+}
+
+
+def evaluate_day(day_dir, ep_path, policies=tuple(POLICIES), params=None, cache_dir=DEFAULT_CACHE_DIR):
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    day = load_day(day_dir, ep_path, params, cache_dir)
+    allocations = {}
+    for name in policies:
+        with profiling.stage(name):
+            allocations[name] = POLICIES[name](day, params)
+    return day["day"], evaluate_allocations(day["real"], allocations, len(day["values"]), day["values"])
+
+
+### evaluate the policies on many extracted days over a process pool ###
+def evaluate_days(day_dirs, ep_path, policies=tuple(POLICIES), params=None, workers=None, cache_dir=DEFAULT_CACHE_DIR):
+    # returns ({day: report}, aggregated report)
+    workers = workers or os.cpu_count()
+    args = [(day_dir, ep_path, policies, params, cache_dir) for day_dir in day_dirs]
+    if workers == 1:
+        results = [evaluate_day(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(evaluate_day, *zip(*args)))
+    per_day = dict(results)
+    return per_day, aggregate_reports(per_day.values())
+
+
+def _jsonable(report):
+    return {name: dict(entry, confusion=entry["confusion"].tolist()) for name, entry in report.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("days", nargs="+", help="extracted day directories, e.g. EP_21")
+    parser.add_argument("--ep", default="epstats.json")
+    parser.add_argument("--policies", nargs="+", default=list(POLICIES), choices=list(POLICIES))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--mortality", default=DEFAULT_PARAMS["mortality"], choices=list(MORTALITY_MAPPINGS),
+                        help="M(S) of the patient values, \"notebook\" for the mapping of model.ipynb")
+    parser.add_argument("--out", default=None, help="write the full report as JSON")
+    parser.add_argument("--profile", default=None,
+                        help="write a JSON run report of the stages to this file (use --workers 1 to see the stages)")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(sample_interval=0.05, days=len(args.days), policies=args.policies, workers=args.workers)
+
+    per_day, total = evaluate_days(args.days, args.ep, args.policies, {"mortality": args.mortality}, args.workers,
+                                   args.cache_dir)
+    for name, entry in total.items():
+        print("%-6s days: %d accuracy: %.4f value: %.2f" % (name, entry["days"], entry["accuracy"], entry["value"]))
+        for unit, m in entry["units"].items():
+            print("    %-18s precision: %.3f recall: %.3f support: %d" % (unit, m["precision"], m["recall"], m["support"]))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({"days": {day: _jsonable(r) for day, r in per_day.items()}, "total": _jsonable(total)}, f, indent=4)
+    if args.profile:
+        profiling.write_report(args.profile)
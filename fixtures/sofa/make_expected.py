@@ -0,0 +1,69 @@
+# Expected output of the SOFA fixture, from the CTE chain of query_updated.sql itself: the tables
+# of this directory are loaded into SQLite and the vaso_stg .. patient_sofa_corrected CTEs are run
+# with the BigQuery table names and DATETIME_SUB / DATETIME_ADD translated, nothing else changed.
+# run from the repository root: python fixtures/sofa/make_expected.py
+# writes expected_stays.csv (patient_sofa) and expected_sofa.csv (patient_sofa_corrected),
+# which python sofa.py fixtures/sofa --check compares sofa.py against
+import csv
+import os
+import re
+import sqlite3
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+QUERY = os.path.join(HERE, "..", "..", "query_updated.sql")
+TABLES = ("icustays", "norepinephrine", "epinephrine", "dobutamine", "dopamine", "bg", "ventilation",
+          "first_day_vitalsign", "first_day_lab", "first_day_urine_output", "first_day_gcs")
+
+
+def sofa_ctes(sql):
+    # the first WITH chain of the query, up to the CTEs that only join the admissions
+    start = sql.index("with vaso_stg as")
+    end = sql.index("icu_transfer_log AS")
+    ctes = sql[start:end].rstrip().rstrip(",")
+    ctes = re.sub(r"`physionet-data\.mimic_\w+\.(\w+)`", r"\1", ctes)
+    ctes = re.sub(r"DATETIME_SUB\((\w+\.\w+), INTERVAL '6' HOUR\)", r"datetime(\1, '-6 hours')", ctes)
+    return re.sub(r"DATETIME_ADD\((\w+\.\w+), INTERVAL '1' DAY\)", r"datetime(\1, '+1 day')", ctes)
+
+
+def _value(text):
+    if text == "":
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def load(conn, name):
+    with open(os.path.join(HERE, name + ".csv"), newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        # '' is NULL, like sofa.read_table, and numbers are stored as numbers like in MIMIC
+        rows = [[_value(v) for v in row] for row in reader]
+    conn.execute("CREATE TABLE %s (%s)" % (name, ", ".join(header)))
+    conn.executemany("INSERT INTO %s VALUES (%s)" % (name, ", ".join("?" * len(header))), rows)
+
+
+def write(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows([["" if v is None else v for v in row] for row in rows])
+
+
+if __name__ == "__main__":
+    conn = sqlite3.connect(":memory:")
+    for name in TABLES:
+        load(conn, name)
+    with open(QUERY) as f:
+        ctes = sofa_ctes(f.read())
+    stays = ["subject_id", "hadm_id", "stay_id", "SOFA", "respiration", "coagulation", "liver", "cardiovascular",
+             "cns", "renal"]
+    write(os.path.join(HERE, "expected_stays.csv"), stays,
+          conn.execute(ctes + "\nSELECT %s FROM patient_sofa ORDER BY stay_id" % ", ".join(stays)).fetchall())
+    write(os.path.join(HERE, "expected_sofa.csv"), ["subject_id", "sofa"],
+          conn.execute(ctes + "\nSELECT subject_id, sofa FROM patient_sofa_corrected ORDER BY subject_id").fetchall())
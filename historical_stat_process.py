@@ -1,4 +1,9 @@
+import argparse
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import profiling
 
 def mapping_sofa_to_mortality(sofa_score):
     # statistics of sofa score mapping to mortality rate
@@ -23,29 +28,63 @@ def mapping_sofa_to_mortality(sofa_score):
         mortality = 0.025 * sofa_score + 0.4
     return round(mortality, 3)
 
+def add_hist_record(newdata, patient):
+    sid = patient["subject_id"]
+    if sid not in newdata:
+        newdata[sid] = {
+            "icd_code": {},
+            "age": patient["age"],
+            "sofa": patient["sofa"],
+            "mortality_by_sofa": mapping_sofa_to_mortality(int(patient["sofa"])),
+            "death": patient["dead_flag"] # 0 means not dead, 1 means dead
+        }
+    if patient["icd_diagnose"] not in newdata[sid]["icd_code"]:
+        newdata[sid]["icd_code"][patient["icd_diagnose"]] = patient["diagnose_priority"]
+    newdata[sid]["result"] = patient["allocation_result"]
+
+@profiling.timed()
 def process_and_save_hist_file(path, new_filename):
     file = open(path)
     newdata = {}
     for patient_data in file.readlines():
-        patient = json.loads(patient_data)
-        sid = patient["subject_id"]
-        if sid not in newdata:
-            newdata[sid] = {
-                "icd_code": {},
-                "age": patient["age"],
-                "sofa": patient["sofa"],
-                "mortality_by_sofa": mapping_sofa_to_mortality(int(patient["sofa"])),
-                "death": patient["dead_flag"] # 0 means not dead, 1 means dead
-            }
-        if patient["icd_diagnose"] not in newdata[sid]["icd_code"]:
-            newdata[sid]["icd_code"][patient["icd_diagnose"]] = patient["diagnose_priority"]
-        newdata[sid]["result"] = patient["allocation_result"]
+        add_hist_record(newdata, json.loads(patient_data))
 
     file.close()
+    profiling.count("historical patients", len(newdata))
     with open(new_filename, 'w') as f:
         json.dump(newdata, f, ensure_ascii=False, indent=4)
 
 
+def accumulate_patient(diagnosis_icu, diagnosis_inpatient, patient_data):
+    current_diagnosis = patient_data["icd_code"]
+    patient_death = int(patient_data["death"])
+    # this patient belongs to icu
+    if patient_data["result"] == "ICU":
+        diagnosis = diagnosis_icu
+    # this patient belongs to general inpatient units
+    else:
+        diagnosis = diagnosis_inpatient
+    for d in current_diagnosis:
+        if d in diagnosis:
+            diagnosis[d][0] += 1
+            diagnosis[d][1] += patient_death
+            diagnosis[d][2] += patient_data["mortality_by_sofa"]
+        else:
+            diagnosis[d] = [1, patient_death, patient_data["mortality_by_sofa"]]
+
+def ep_from_stats(diagnosis_icu, diagnosis_inpatient):
+    # Ep_d = (sum of mortality_by_sofa - number of deaths) / number of patients, per unit
+    ep_icu_noicu = {}
+    for k1, v1 in diagnosis_icu.items():
+        ep_icu_noicu[k1] = [(v1[2]-v1[1])/v1[0], 0]
+    for k2, v2 in diagnosis_inpatient.items():
+        if k2 in ep_icu_noicu:
+            ep_icu_noicu[k2][1] = (v2[2]-v2[1])/v2[0]
+        else:
+            ep_icu_noicu[k2] = [0, (v2[2]-v2[1])/v2[0]]
+    return ep_icu_noicu
+
+@profiling.timed()
 def calculate_hist_patient_prob(path, new_filename):
     file = open(path)
     data = json.load(file)
@@ -60,26 +99,7 @@ def calculate_hist_patient_prob(path, new_filename):
     diagnosis_inpatient = {}
     # put patients' diagnoses into the corresponding dictionary
     for patient_data in full_hist_data.values():
-        current_diagnosis = patient_data["icd_code"]
-        patient_death = int(patient_data["death"])
-        # this patient belongs to icu
-        if patient_data["result"] == "ICU":
-            for diagnosis in current_diagnosis:
-                if diagnosis in diagnosis_icu:
-                    diagnosis_icu[diagnosis][0] += 1
-                    diagnosis_icu[diagnosis][1] += patient_death
-                    diagnosis_icu[diagnosis][2] += patient_data["mortality_by_sofa"]
-                else:
-                    diagnosis_icu[diagnosis] = [1, patient_death, patient_data["mortality_by_sofa"]]
-        # this patient belongs to general inpatient units
-        else:
-            for diagnosis in current_diagnosis:
-                if diagnosis in diagnosis_inpatient:
-                    diagnosis_inpatient[diagnosis][0] += 1
-                    diagnosis_inpatient[diagnosis][1] += patient_death
-                    diagnosis_inpatient[diagnosis][2] += patient_data["mortality_by_sofa"]
-                else:
-                    diagnosis_inpatient[diagnosis] = [1, patient_death, patient_data["mortality_by_sofa"]]
+        accumulate_patient(diagnosis_icu, diagnosis_inpatient, patient_data)
 
     file.close()
     # print(diagnosis_icu)
@@ -105,18 +125,124 @@ def calculate_hist_patient_prob(path, new_filename):
     #             ep_icu_noicu[k2] = [0, (v2[2]-v2[1])/v2[0]]
 
     # the version that has no rounding
-    for k1, v1 in diagnosis_icu.items():
-        ep_icu_noicu[k1] = [(v1[2]-v1[1])/v1[0], 0]
-    for k2, v2 in diagnosis_inpatient.items():
-        if k2 in ep_icu_noicu:
-            ep_icu_noicu[k2][1] = (v2[2]-v2[1])/v2[0]
-        else:
-            ep_icu_noicu[k2] = [0, (v2[2]-v2[1])/v2[0]]
+    ep_icu_noicu = ep_from_stats(diagnosis_icu, diagnosis_inpatient)
+    profiling.count("historical patients", len(full_hist_data))
+    profiling.count("icd codes", len(ep_icu_noicu))
 
     # print(ep_icu_noicu)
     with open(new_filename, 'w') as f:
         json.dump(ep_icu_noicu, f, ensure_ascii=False, indent=4)
 
+### one-pass, parallel version of process_and_save_hist_file + calculate_hist_patient_prob ###
+# the historical query output is ORDER BY subject_id, so the file is cut into byte ranges
+# that never split the records of one patient; every range is aggregated by its own
+# process into partial [count, deaths, sum mortality_by_sofa] tables, which are merged
+
+def _subject_id(line):
+    return json.loads(line)["subject_id"]
+
+def shard_boundaries(path, n_shards):
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as file:
+        for k in range(1, n_shards):
+            offset = max(size * k // n_shards, boundaries[-1])
+            file.seek(offset)
+            if offset > 0:
+                file.readline() # skip the partial line
+            first = file.readline()
+            if not first:
+                break
+            sid = _subject_id(first)
+            # move forward to the first line of the next patient
+            start = file.tell()
+            line = file.readline()
+            while line and _subject_id(line) == sid:
+                start = file.tell()
+                line = file.readline()
+            if not line:
+                break
+            if start > boundaries[-1]:
+                boundaries.append(start)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+### group contiguous historical records into (subject_id, patient) pairs, add_hist_record format ###
+def iter_hist_patients(records):
+    current = {}
+    for patient in records:
+        # a new subject_id means the current patient is complete
+        if patient["subject_id"] not in current:
+            yield from current.items()
+            current = {}
+        add_hist_record(current, patient)
+    yield from current.items()
+
+def _iter_range(path, start, end):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while file.tell() < end:
+            line = file.readline()
+            if line.strip():
+                yield json.loads(line)
+
+def aggregate_shard(path, start, end):
+    diagnosis_icu = {}
+    diagnosis_inpatient = {}
+    for sid, patient_data in iter_hist_patients(_iter_range(path, start, end)):
+        accumulate_patient(diagnosis_icu, diagnosis_inpatient, patient_data)
+    return diagnosis_icu, diagnosis_inpatient
+
+def merge_hist_stats(a, b):
+    # merges the (diagnosis_icu, diagnosis_inpatient) tables of b into a
+    for diagnosis_a, diagnosis_b in zip(a, b):
+        for d, v in diagnosis_b.items():
+            if d in diagnosis_a:
+                diagnosis_a[d][0] += v[0]
+                diagnosis_a[d][1] += v[1]
+                diagnosis_a[d][2] += v[2]
+            else:
+                diagnosis_a[d] = list(v)
+    return a
+
+@profiling.timed()
+def aggregate_hist_file(path, workers=None):
+    workers = workers or os.cpu_count()
+    shards = shard_boundaries(path, workers * 4)
+    stats = ({}, {})
+    if workers == 1:
+        for start, end in shards:
+            merge_hist_stats(stats, aggregate_shard(path, start, end))
+        return stats
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(aggregate_shard, path, start, end) for start, end in shards]
+        for future in futures:
+            merge_hist_stats(stats, future.result())
+    return stats
+
+def calculate_hist_stats_parallel(path, new_filename, workers=None):
+    diagnosis_icu, diagnosis_inpatient = aggregate_hist_file(path, workers)
+    ep_icu_noicu = ep_from_stats(diagnosis_icu, diagnosis_inpatient)
+    profiling.count("icd codes", len(ep_icu_noicu))
+    with open(new_filename, 'w') as f:
+        json.dump(ep_icu_noicu, f, ensure_ascii=False, indent=4)
+
 if __name__ == "__main__":
-    process_and_save_hist_file("historical.json", "newhistorydata.json")
-    calculate_hist_patient_prob("newhistorydata.json", "epstats.json")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parallel", action="store_true",
+                        help="aggregate historical.json in one pass over a process pool, without newhistorydata.json")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes for --parallel")
+    parser.add_argument("--profile", default=None, help="write a JSON run report of the stages to this file")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(sample_interval=0.05, parallel=args.parallel)
+
+    if args.parallel:
+        calculate_hist_stats_parallel("historical.json", "epstats.json", args.workers)
+    else:
+        process_and_save_hist_file("historical.json", "newhistorydata.json")
+        calculate_hist_patient_prob("newhistorydata.json", "epstats.json")
+
+    if args.profile:
+        profiling.write_report(args.profile)
+        profiling.print_report()
@@ -0,0 +1,163 @@
+import heapq
+import itertools
+
+import numpy as np
+
+# "most deteriorated first" baseline: patients are ranked by SOFA score (highest first)
+# and fill the units in order, e.g. capacities = [ICU beds, general beds]; whoever is
+# left over is rejected
+
+MAX_SOFA = 24
+# the heaps of an MDFStream unit are rebuilt once they hold more stale entries than live ones
+# (plus this many, so small units are not rebuilt at every move)
+HEAP_SLACK = 32
+
+
+### rank of every patient, most deteriorated first ###
+def mdf_order(sofa, tie_key=None):
+    # tie_key: patients with the same SOFA score are ranked by increasing tie_key, e.g. -age
+    # for the oldest first or the arrival time for first come first served; by default they
+    # keep their input order
+    # SOFA is an integer in 0..24, so a stable sort on it is a counting (radix) sort in O(P)
+    keys = MAX_SOFA - np.asarray(sofa, dtype=np.int8)
+    if tie_key is None:
+        return np.argsort(keys, kind="stable")
+    order = np.argsort(np.asarray(tie_key), kind="stable")
+    return order[np.argsort(keys[order], kind="stable")]
+
+
+### unit index of every patient, len(capacities) means rejected ###
+def mdf_alloc(sofa, capacities, tie_key=None):
+    # capacities are numbers of beds, fractional capacities (e.g. R_icu * Umax) are floored
+    bounds = np.cumsum([int(c) for c in capacities])
+    order = mdf_order(sofa, tie_key)
+    units = np.empty(len(order), dtype=np.int64)
+    units[order] = np.searchsorted(bounds, np.arange(len(order)), side="right")
+    return units
+
+
+### the [icu, inpatient, rejected] lists of mdf_alloc in model.ipynb ###
+def mdf_alloc_lists(sofa, ricu, rgn, p_num=None, tie_key=None):
+    # p_num: label of every patient, defaults to its index
+    units = mdf_alloc(sofa, [ricu, rgn], tie_key)
+    order = mdf_order(sofa, tie_key)
+    labels = np.arange(len(units)) if p_num is None else np.asarray(p_num)
+    # keep the most deteriorated first order inside every list
+    return [labels[order[units[order] == unit]].tolist() for unit in range(3)]
+
+
+### online version: assigns the patients one by one as they arrive ###
+class MDFStream:
+    # every unit keeps a min-heap of its patients keyed by (SOFA, -tie), so that the least
+    # deteriorated patient is on top; a new patient goes to the first unit, and when a unit
+    # is over capacity its least deteriorated patient is pushed down to the next unit. Every
+    # unit and the rejected patients also keep a max-heap, so that a discharge pulls the most
+    # deteriorated patient of the next unit up into the free bed, cascading down. After every
+    # arrival and discharge the units hold the same patients as mdf_alloc on everyone present.
+    # Heap entries of patients that moved or left are dropped lazily, an entry is live while
+    # its token is the one in placement, and the heaps of a unit are rebuilt from its live
+    # entries when the stale ones outnumber them (see _compact).
+
+    def __init__(self, capacities):
+        self.capacities = [int(c) for c in capacities]
+        self.heaps = [[] for _ in self.capacities]
+        self.tops = [[] for _ in range(len(self.capacities) + 1)]
+        # patients in every unit, and the rejected ones last
+        self.sizes = [0] * (len(self.capacities) + 1)
+        # patient_id -> (unit, token of its heap entries)
+        self.placement = {}
+        self.counter = itertools.count()
+        self.tokens = itertools.count()
+
+    def assign(self, patient_id, sofa, tie=None):
+        # returns the list of (patient_id, unit) placements caused by this arrival, unit ==
+        # len(capacities) means rejected; tie defaults to the arrival order
+        seq = next(self.counter)
+        # among equal keys the later arrival is the one pushed down, like the stable batch order
+        key = (int(sofa), -(seq if tie is None else tie), -seq)
+        moves = []
+        for unit in range(len(self.capacities)):
+            if self.capacities[unit] == 0:
+                continue
+            self._place(unit, key, patient_id)
+            if self.sizes[unit] <= self.capacities[unit]:
+                moves.append((patient_id, unit))
+                return moves
+            popped_key, popped = self._pop(unit)
+            if popped != patient_id:
+                moves.append((patient_id, unit))
+            key, patient_id = popped_key, popped
+        rejected = len(self.capacities)
+        self._place(rejected, key, patient_id)
+        moves.append((patient_id, rejected))
+        return moves
+
+    def unit(self, patient_id):
+        return self.placement[patient_id][0]
+
+    def release(self, patient_id):
+        # frees the bed of a discharged patient; the most deteriorated patient of the next unit
+        # moves up into it, which frees a bed there, and so on down to the rejected patients
+        # returns the list of (patient_id, unit) moves caused by the discharge
+        unit, _ = self.placement.pop(patient_id, (None, None))
+        moves = []
+        if unit is None:
+            return moves
+        self.sizes[unit] -= 1
+        self._compact(unit)
+        while unit < len(self.capacities):
+            below = next((u for u in range(unit + 1, len(self.capacities)) if self.capacities[u] > 0),
+                         len(self.capacities))
+            top = self._pop_top(below)
+            if top is None:
+                break
+            key, moved = top
+            self._place(unit, key, moved)
+            moves.append((moved, unit))
+            unit = below
+        return moves
+
+    def _place(self, unit, key, patient_id):
+        token = next(self.tokens)
+        self.placement[patient_id] = (unit, token)
+        if unit < len(self.capacities):
+            heapq.heappush(self.heaps[unit], key + (token, patient_id))
+        heapq.heappush(self.tops[unit], (-key[0], -key[1], -key[2], token, patient_id))
+        self.sizes[unit] += 1
+        self._compact(unit)
+
+    def _pop(self, unit):
+        # least deteriorated patient of a unit, skipping the stale entries
+        heap = self.heaps[unit]
+        while True:
+            entry = heapq.heappop(heap)
+            if self.placement.get(entry[4]) == (unit, entry[3]):
+                self.sizes[unit] -= 1
+                self._compact(unit)
+                return entry[:3], entry[4]
+
+    def _pop_top(self, unit):
+        # most deteriorated patient of a unit (or of the rejected ones), None when there is none
+        heap = self.tops[unit]
+        while heap:
+            entry = heapq.heappop(heap)
+            if self.placement.get(entry[4]) == (unit, entry[3]):
+                self.sizes[unit] -= 1
+                self._compact(unit)
+                return (-entry[0], -entry[1], -entry[2]), entry[4]
+        return None
+
+    def _compact(self, unit):
+        # rebuilds the heaps of a unit from its live entries once they are mostly stale; every
+        # rebuild follows at least as many moves as the unit has patients, so it costs O(1)
+        # amortized per move
+        limit = 2 * self.sizes[unit] + HEAP_SLACK
+        if len(self.tops[unit]) <= limit and (unit == len(self.capacities) or len(self.heaps[unit]) <= limit):
+            return
+        live = [entry for entry in self.tops[unit] if self.placement.get(entry[4]) == (unit, entry[3])]
+        heapq.heapify(live)
+        self.tops[unit] = live
+        if unit < len(self.capacities):
+            heap = [(-entry[0], -entry[1], -entry[2], entry[3], entry[4]) for entry in live]
+            heapq.heapify(heap)
+            self.heaps[unit] = heap
@@ -0,0 +1,126 @@
+import numpy as np
+from scipy import sparse
+
+import profiling
+
+# every patient owns 4 consecutive columns in the decision vector:
+# [ICU, general inpatient, ICU waitlist, rejection]
+N_UNITS = 4
+ICU, INPATIENT, WAITLIST, REJECT = range(N_UNITS)
+
+# objective multipliers of existing ICU patients (status == 1),
+# they are slightly favoured to stay in ICU
+EXISTING_ICU_BONUS = 1.02
+EXISTING_NOICU_PENALTY = 0.98
+
+# parameters of the allocation model and of V_p = w1 * L_p + w2 * age / 100 (patient_values.py),
+# the values of model.ipynb; evaluation.py, simulator.py and service.py add their own settings
+DEFAULT_PARAMS = {
+    "R_icu": 77,  # Number of ICU resources (beds)
+    "R_noicu": 600,  # Number of general inpatient beds available per epoch
+    "Umax": 0.85,  # ICU resource max usage (percentage)
+    "w1": 0.5,
+    "w2": 0.8,
+    "ew": 0.99,
+    "wl_len": 0,
+    "WL_step": 3,
+}
+
+
+### coefficient of the waitlist column for a given waitlist length ###
+def waitlist_factor(wl_len, WL_step, ew):
+    # Vp_WL = ew / (wl_len + WL_step/2) * Vp_ICU
+    return ew / (wl_len + WL_step / 2)
+
+
+### objective vector (to be minimized) of the allocation LP ###
+def build_objective(v_icu, v_noicu, status, wl_len, WL_step, ew):
+    # v_icu, v_noicu: value V_p of every patient in ICU / out of ICU
+    # status: 0 for incoming patients, 1 for existing ICU patients
+    v_icu = np.asarray(v_icu, dtype=float)
+    v_noicu = np.asarray(v_noicu, dtype=float)
+    existing = np.asarray(status) == 1
+    c = np.zeros((len(v_icu), N_UNITS))
+    c[:, ICU] = -np.where(existing, v_icu * EXISTING_ICU_BONUS, v_icu)
+    c[:, INPATIENT] = -np.where(existing, v_noicu * EXISTING_NOICU_PENALTY, v_noicu)
+    c[:, WAITLIST] = -waitlist_factor(wl_len, WL_step, ew) * v_icu
+    return c.ravel()
+
+
+### inequality constraints: capacities and the waitlist length window ###
+def build_ub(total, R_icu, R_noicu, Umax, wl_len, WL_step):
+    # row 0: sum X_p,ICU <= R_icu * Umax
+    # row 1: sum X_p,INPATIENT + X_p,WAITLIST <= R_noicu
+    # row 2: sum X_p,WAITLIST <= wl_len + WL_step
+    # row 3: -sum X_p,WAITLIST <= 1 - wl_len
+    base = np.arange(total) * N_UNITS
+    rows = np.repeat([0, 1, 1, 2, 3], total)
+    cols = np.concatenate([base + ICU, base + INPATIENT, base + WAITLIST, base + WAITLIST, base + WAITLIST])
+    data = np.repeat([1.0, 1.0, 1.0, 1.0, -1.0], total)
+    A_ub = sparse.coo_matrix((data, (rows, cols)), shape=(4, N_UNITS * total)).tocsr()
+    b_ub = build_ub_rhs(R_icu, R_noicu, Umax, wl_len, WL_step)
+    return A_ub, b_ub
+
+
+def build_ub_rhs(R_icu, R_noicu, Umax, wl_len, WL_step):
+    return np.array([int(R_icu * Umax), R_noicu, wl_len + WL_step, 1 - wl_len], dtype=float)
+
+
+### equality constraints: every patient gets exactly one allocation ###
+def build_eq(total):
+    # row p has ones on columns 4p..4p+3, so the CSR arrays can be written down directly
+    indptr = np.arange(0, N_UNITS * total + 1, N_UNITS)
+    indices = np.arange(N_UNITS * total)
+    data = np.ones(N_UNITS * total)
+    A_eq = sparse.csr_matrix((data, indices, indptr), shape=(total, N_UNITS * total))
+    b_eq = np.ones(total)
+    return A_eq, b_eq
+
+
+def build_bounds(total):
+    lb = np.zeros(N_UNITS * total)
+    ub = np.ones(N_UNITS * total)
+    return np.column_stack((lb, ub))
+
+
+### the whole allocation LP, as keyword arguments of scipy.optimize.linprog ###
+@profiling.timed()
+def build_model(v_icu, v_noicu, status, R_icu, R_noicu, Umax, wl_len, WL_step, ew):
+    total = len(v_icu)
+    A_ub, b_ub = build_ub(total, R_icu, R_noicu, Umax, wl_len, WL_step)
+    A_eq, b_eq = build_eq(total)
+    profiling.count("nonzeros", A_ub.nnz + A_eq.nnz)
+    return {
+        "c": build_objective(v_icu, v_noicu, status, wl_len, WL_step, ew),
+        "A_ub": A_ub,
+        "b_ub": b_ub,
+        "A_eq": A_eq,
+        "b_eq": b_eq,
+        "bounds": build_bounds(total),
+    }
+
+
+### the original list-of-lists construction in model.ipynb, kept for comparison ###
+def build_dense_model(v_icu, v_noicu, status, R_icu, R_noicu, Umax, wl_len, WL_step, ew):
+    total = len(v_icu)
+    obj = []
+    lhs = []
+    lhs.append([1, 0, 0, 0]*total)
+    lhs.append([0, 1, 1, 0]*total)
+    lhs.append([0, 0, 1, 0]*total)
+    lhs.append([0, 0, -1, 0]*total)
+    rhs = [int(R_icu*Umax), R_noicu, wl_len+WL_step, 1-wl_len]
+    lhs_eq = []
+    rhs_eq = []
+    bnd = []
+    for i in range(total):
+        if status[i] == 0:
+            obj += [-v_icu[i], -v_noicu[i], -waitlist_factor(wl_len, WL_step, ew)*v_icu[i], 0]
+        else:
+            obj += [-v_icu[i]*EXISTING_ICU_BONUS, -v_noicu[i]*EXISTING_NOICU_PENALTY,
+                    -waitlist_factor(wl_len, WL_step, ew)*v_icu[i], 0]
+        lhs_eq.append([0]*i*4 + [1, 1, 1, 1] + [0]*(4*(total-i-1)))
+        rhs_eq.append(1)
+        for j in range(4):
+            bnd.append((0, 1))
+    return {"c": obj, "A_ub": lhs, "b_ub": rhs, "A_eq": lhs_eq, "b_eq": rhs_eq, "bounds": bnd}
@@ -0,0 +1,213 @@
+import numpy as np
+from scipy import sparse
+
+from model_builder import EXISTING_ICU_BONUS, EXISTING_NOICU_PENALTY
+from solver import solve_allocation
+
+# Allocation over a network of N care units (e.g. the MICU / SICU / CCU / general wards of
+# several sites, as in the MIMIC careunit column), each with its own capacity. Every patient
+# owns N + 1 consecutive columns in the decision vector: one per unit, then rejection, so
+# units[p] == N means rejected, like mdf.mdf_alloc.
+# The profit of patient p in unit u is values[p, u] - costs[p, u], where costs holds the
+# transfer costs (e.g. between sites, or out of the unit an existing patient occupies).
+# The exact model is solved like the 4-column model of model_builder.py; for large networks
+# solve_lagrangian relaxes the capacity rows, so that the problem splits into one subproblem
+# per patient (pick the unit of highest profit minus the unit price) solved for everyone at
+# once, which costs O(patients x units) per iteration.
+
+
+### value of every patient in every unit, from the V_p of model.ipynb ###
+def unit_values(v_icu, v_noicu, is_icu, current=None):
+    # is_icu: bool per unit, ICU units get V_ICU and the others V_non-ICU
+    # current: unit occupied by every patient, -1 for incoming patients; existing patients
+    # are favoured to stay in their unit, and those in an ICU unit are penalized out of ICU,
+    # like status 1 in build_objective
+    v_icu = np.asarray(v_icu, dtype=float)
+    v_noicu = np.asarray(v_noicu, dtype=float)
+    is_icu = np.asarray(is_icu, dtype=bool)
+    values = np.where(is_icu, v_icu[:, None], v_noicu[:, None])
+    if current is not None:
+        current = np.asarray(current)
+        existing = np.flatnonzero(current >= 0)
+        in_icu = existing[is_icu[current[existing]]]
+        values[in_icu[:, None], ~is_icu] *= EXISTING_NOICU_PENALTY
+        values[existing, current[existing]] *= EXISTING_ICU_BONUS
+    return values
+
+
+### transfer cost of every patient to every unit ###
+def transfer_costs(origin, origin_costs):
+    # origin: origin index of every patient (e.g. its current site or unit)
+    # origin_costs: (origins, units) matrix, the cost of moving from an origin into a unit
+    return np.asarray(origin_costs, dtype=float)[np.asarray(origin)]
+
+
+def site_costs(unit_site, site_transfer):
+    # (sites, units) origin_costs from a (sites, sites) matrix of the cost of moving between sites
+    return np.asarray(site_transfer, dtype=float)[:, np.asarray(unit_site)]
+
+
+def _profits(values, costs):
+    profits = np.asarray(values, dtype=float)
+    if costs is not None:
+        profits = profits - costs
+    return profits
+
+
+### the exact model, as keyword arguments of scipy.optimize.linprog ###
+def build_network_model(values, capacities, costs=None):
+    profits = _profits(values, costs)
+    total, n_units = profits.shape
+    width = n_units + 1
+    c = np.zeros((total, width))
+    c[:, :n_units] = -profits
+    # row u: sum_p X_p,u <= capacities[u]
+    cols = (np.arange(total)[None, :] * width + np.arange(n_units)[:, None]).ravel()
+    rows = np.repeat(np.arange(n_units), total)
+    A_ub = sparse.csr_matrix((np.ones(total * n_units), (rows, cols)), shape=(n_units, width * total))
+    # row p: sum_u X_p,u + X_p,reject == 1
+    A_eq = sparse.csr_matrix((np.ones(width * total), np.arange(width * total), np.arange(0, width * total + 1, width)),
+                             shape=(total, width * total))
+    return {
+        "c": c.ravel(),
+        "A_ub": A_ub,
+        "b_ub": np.floor(np.asarray(capacities, dtype=float)),
+        "A_eq": A_eq,
+        "b_eq": np.ones(total),
+        "bounds": np.column_stack((np.zeros(width * total), np.ones(width * total))),
+    }
+
+
+def _objective(profits, units):
+    n_units = profits.shape[1]
+    placed = np.flatnonzero(units < n_units)
+    return float(profits[placed, units[placed]].sum())
+
+
+### solve the exact model with a backend of solver.py ###
+def solve_exact(values, capacities, costs=None, backend="milp", **options):
+    profits = _profits(values, costs)
+    total, n_units = profits.shape
+    result = solve_allocation(build_network_model(profits, capacities), backend, **options)
+    if result.x is None:
+        raise ValueError("no allocation found: " + str(result.message))
+    units = np.asarray(result.x).reshape(total, n_units + 1).argmax(axis=1)
+    objective = _objective(profits, units)
+    return {"units": units, "objective": objective, "bound": objective, "multipliers": None, "iterations": None}
+
+
+### make the choices of the relaxation respect the capacities ###
+def _repair(reduced, units, capacities):
+    # reduced: profits minus the unit prices, with a last column of zeros for rejection
+    # while a unit is over capacity it keeps the patients that would lose the most by moving
+    # (highest regret) and the others move to their next best unit with free beds; a patient is
+    # never sent back to a unit that evicted it, and rejection has no capacity, so this ends
+    n_units = reduced.shape[1] - 1
+    allowed = reduced.copy()
+    units = units.copy()
+    while True:
+        over = np.bincount(units, minlength=n_units + 1)[:n_units] > capacities
+        if not over.any():
+            return units
+        # only the patients of the units over capacity are ranked
+        members = np.flatnonzero(np.append(over, False)[units])
+        choices = allowed[members]
+        own = choices[np.arange(len(members)), units[members]]
+        top2 = -np.partition(-choices, 1, axis=1)[:, :2]
+        regret = own - np.where(own == top2[:, 0], top2[:, 1], top2[:, 0])
+        order = np.lexsort((-regret, units[members]))
+        members, member_units = members[order], units[members][order]
+        # rank of every member inside its unit, by decreasing regret
+        rank = np.arange(len(members)) - np.searchsorted(member_units, member_units)
+        evicted = members[rank >= capacities[member_units]]
+        allowed[evicted, units[evicted]] = -np.inf
+        # the evicted patients go to their best unit that still has free beds
+        kept = np.bincount(units, minlength=n_units + 1) - np.bincount(units[evicted], minlength=n_units + 1)
+        choices = allowed[evicted]
+        choices[:, np.flatnonzero(kept[:n_units] >= capacities)] = -np.inf
+        units[evicted] = choices.argmax(axis=1)
+
+
+### move patients into the beds a repaired allocation leaves free, when it pays off ###
+def _fill(profits, units, capacities):
+    # one pass over the units: the patients that gain the most by moving take the free beds
+    total, n_units = profits.shape
+    current = np.zeros(total)
+    placed = units < n_units
+    current[placed] = profits[placed, units[placed]]
+    units = units.copy()
+    load = np.bincount(units, minlength=n_units + 1)[:n_units]
+    for unit in range(n_units):
+        spare = int(capacities[unit] - load[unit])
+        if spare <= 0:
+            continue
+        gain = profits[:, unit] - current
+        candidates = np.flatnonzero((gain > 0) & (units != unit))
+        movers = candidates[np.argsort(-gain[candidates], kind="stable")[:spare]]
+        np.subtract.at(load, units[movers][units[movers] < n_units], 1)
+        load[unit] += len(movers)
+        units[movers] = unit
+        current[movers] = profits[movers, unit]
+    return units
+
+
+### Lagrangian relaxation of the capacity rows, solved by subgradient steps on the unit prices ###
+def solve_lagrangian(values, capacities, costs=None, max_iter=200, tol=1e-4, step=2.0, patience=10,
+                     repair_every=10, multipliers=None):
+    # returns the repaired (feasible) allocation of highest objective, and the best dual bound:
+    # the optimum lies between "objective" and "bound"
+    # multipliers: starting unit prices, e.g. those of a previous solve (warm start)
+    profits = _profits(values, costs)
+    total, n_units = profits.shape
+    capacities = np.floor(np.asarray(capacities, dtype=float))
+    prices = np.zeros(n_units) if multipliers is None else np.asarray(multipliers, dtype=float).copy()
+    reduced = np.zeros((total, n_units + 1))
+    rows = np.arange(total)
+    best_units, best_objective = np.full(total, n_units), 0.0
+    best_bound, stalled = np.inf, 0
+    iteration = 0
+    for iteration in range(1, max_iter + 1):
+        # every patient takes the unit of highest profit minus price, or rejection (0)
+        reduced[:, :n_units] = profits - prices
+        units = reduced.argmax(axis=1)
+        bound = float(reduced[rows, units].sum() + prices @ capacities)
+        if bound < best_bound - 1e-9:
+            best_bound, stalled = bound, 0
+        else:
+            stalled += 1
+            if stalled >= patience:
+                step, stalled = step / 2, 0
+        load = np.bincount(units, minlength=n_units + 1)[:n_units]
+        subgradient = load - capacities
+        if (iteration - 1) % repair_every == 0 or (subgradient <= 0).all():
+            repaired = _fill(profits, _repair(reduced, units, capacities), capacities)
+            objective = _objective(profits, repaired)
+            if objective > best_objective:
+                best_units, best_objective = repaired, objective
+        if best_bound - best_objective <= tol * max(abs(best_bound), 1.0):
+            break
+        # prices of units with spare capacity go down, no lower than 0
+        subgradient = np.where((prices <= 0) & (subgradient < 0), 0, subgradient)
+        norm = subgradient @ subgradient
+        if norm == 0:
+            break
+        prices = np.maximum(prices + step * (best_bound - best_objective) / norm * subgradient, 0)
+    reduced[:, :n_units] = profits - prices
+    repaired = _fill(profits, _repair(reduced, reduced.argmax(axis=1), capacities), capacities)
+    objective = _objective(profits, repaired)
+    if objective > best_objective:
+        best_units, best_objective = repaired, objective
+    return {"units": best_units, "objective": best_objective, "bound": best_bound, "multipliers": prices,
+            "iterations": iteration}
+
+
+SOLVE_MODES = {
+    "exact": solve_exact,
+    "lagrangian": solve_lagrangian,
+}
+
+
+def solve_network(values, capacities, costs=None, mode="exact", **options):
+    if mode not in SOLVE_MODES:
+        raise ValueError("unknown solve mode: " + str(mode) + ", choose from " + str(list(SOLVE_MODES)))
+    return SOLVE_MODES[mode](values, capacities, costs, **options)
@@ -0,0 +1,140 @@
+import numpy as np
+from scipy import sparse
+
+import profiling
+from historical_stat_process import mapping_sofa_to_mortality
+
+MAX_SOFA = 24
+ICU_FLAG, NOICU_FLAG = 0, 1
+
+# arrays of a compiled census that are not indexed by patient
+DIAG_KEYS = ("diag_indptr", "diag_indices", "diag_priority")
+ICD_KEYS = ("icd_codes", "ep_table")
+
+
+### compile the census dict (newindata.json / newexdata.json format) into flat arrays ###
+@profiling.timed()
+def compile_patients(data, sids=None):
+    # the diagnoses of patient i are diag_indices[diag_indptr[i]:diag_indptr[i+1]] (indices into icd_codes)
+    # with the diagnosis priorities (seq_num) in diag_priority at the same positions
+    if sids is None:
+        sids = list(data)
+    total = len(sids)
+    status = np.empty(total, dtype=np.int8)
+    age = np.empty(total, dtype=float)
+    sofa = np.empty(total, dtype=np.int8)
+    diag_indptr = np.zeros(total + 1, dtype=np.int64)
+    icd_index = {}
+    diag_indices = []
+    diag_priority = []
+    for i, sid in enumerate(sids):
+        patient = data[sid]
+        status[i] = patient["status"]
+        age[i] = int(patient["age"])
+        sofa[i] = patient["SOFA"]
+        for diag, priority in patient["icd_code"].items():
+            diag_indices.append(icd_index.setdefault(diag, len(icd_index)))
+            diag_priority.append(int(priority))
+        diag_indptr[i + 1] = len(diag_indices)
+    return {
+        "sids": np.array(sids, dtype=str),
+        "status": status,
+        "age": age,
+        "sofa": sofa,
+        "diag_indptr": diag_indptr,
+        "diag_indices": np.array(diag_indices, dtype=np.int32),
+        "diag_priority": np.array(diag_priority, dtype=np.int32),
+        "icd_codes": np.array(list(icd_index), dtype=str),
+    }
+
+
+### dense ICD x {ICU, non-ICU} table of Ep_d, in the order of compiled["icd_codes"] ###
+def compile_ep(Ep_d, icd_codes):
+    # diagnoses without historical statistics contribute 0, like the KeyError branch of calculate_l_p
+    ep_table = np.zeros((len(icd_codes), 2))
+    for j, diag in enumerate(icd_codes):
+        if diag in Ep_d:
+            ep_table[j] = Ep_d[diag]
+    return ep_table
+
+
+### the mapping_sofa_to_mortality of model.ipynb ###
+def notebook_sofa_to_mortality(sofa_score):
+    # unlike historical_stat_process.py, the notebook uses 0.1 / S for S = 1..6, and S = 0 falls
+    # through to the last branch (0.4)
+    assert 0 <= sofa_score <= MAX_SOFA
+    if 0 < sofa_score <= 6:
+        mortality = 0.1 / sofa_score
+    elif 7 <= sofa_score <= 9:
+        mortality = 0.1 * sofa_score - 0.55
+    elif 10 <= sofa_score <= 12:
+        mortality = 0.05 * sofa_score - 0.1
+    elif 13 <= sofa_score <= 15:
+        mortality = 0.1 * sofa_score - 0.75
+    else:
+        mortality = 0.025 * sofa_score + 0.4
+    return round(mortality, 3)
+
+
+# M(S) mappings by name: "historical" is the one the Ep_d statistics are computed with
+MORTALITY_MAPPINGS = {
+    "historical": mapping_sofa_to_mortality,
+    "notebook": notebook_sofa_to_mortality,
+}
+
+
+### lookup table of M(S) for S = 0..24 ###
+def sofa_mortality_table(mapping=mapping_sofa_to_mortality):
+    # mapping: a function or a name of MORTALITY_MAPPINGS; model.ipynb defines its own
+    # mapping_sofa_to_mortality, pass it (or "notebook") to reproduce the notebook exactly
+    if isinstance(mapping, str):
+        mapping = MORTALITY_MAPPINGS[mapping]
+    return np.array([mapping(s) for s in range(MAX_SOFA + 1)])
+
+
+### CSR patient x ICD matrix of the normalized priority weights ###
+def priority_weights(compiled):
+    # weight of diagnosis d of patient p: (1/seq_num_d) / sum_d' (1/seq_num_d')
+    indptr = compiled["diag_indptr"]
+    inv = 1.0 / compiled["diag_priority"]
+    counts = np.diff(indptr)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    row_sums = np.bincount(rows, weights=inv, minlength=len(counts))
+    data = inv / row_sums[rows]
+    return sparse.csr_matrix((data, compiled["diag_indices"], indptr),
+                             shape=(len(counts), len(compiled["icd_codes"])))
+
+
+### L_p of every patient, column 0 in ICU, column 1 out of ICU ###
+def calculate_l_p_all(compiled, ep_table, mortality_table=None, weights=None):
+    if mortality_table is None:
+        mortality_table = sofa_mortality_table()
+    if weights is None:
+        weights = priority_weights(compiled)
+    l_p = 1 - mortality_table[compiled["sofa"]][:, None] + weights @ ep_table
+    return np.clip(l_p, 0, 1)
+
+
+### V_p of every patient, column 0 in ICU, column 1 out of ICU ###
+@profiling.timed("calculate_v_p")
+def calculate_v_p_all(compiled, ep_table, w1, w2, mortality_table=None, weights=None):
+    profiling.count("patients valued", len(compiled["sids"]))
+    profiling.count("diagnoses", len(compiled["diag_indices"]))
+    l_p = calculate_l_p_all(compiled, ep_table, mortality_table, weights)
+    return w1 * l_p + w2 * (compiled["age"] / 100)[:, None]
+
+
+### the compiled arrays of a subset of the patients, rows is an index array or a boolean mask ###
+def take_patients(compiled, rows):
+    rows = np.arange(len(compiled["sids"]))[rows]
+    indptr = compiled["diag_indptr"]
+    counts = indptr[rows + 1] - indptr[rows]
+    # positions of the kept diagnoses in the flat diagnosis arrays
+    positions = np.repeat(indptr[rows] - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + np.arange(counts.sum())
+    # every other array has one entry per patient, or one per ICD code (kept as is)
+    subset = {key: value if key in ICD_KEYS else value[rows]
+              for key, value in compiled.items() if key not in DIAG_KEYS}
+    subset["diag_indptr"] = np.concatenate([[0], np.cumsum(counts)])
+    subset["diag_indices"] = compiled["diag_indices"][positions]
+    subset["diag_priority"] = compiled["diag_priority"][positions]
+    return subset
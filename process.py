@@ -1,46 +1,132 @@
+import argparse
 import json
-import random
 
+import profiling
+
+def add_record(newdata, type, patient):
+    sid = patient["subject_id"]
+    #type == 0: # incoming patients
+    if sid not in newdata:
+        newdata[sid] = {
+            "status": type,
+            "icd_code": {},
+            "age": patient["age"],
+            "SOFA": int(patient["sofa"]) #,random.randint(1, 24)
+        }
+    if type == 1 and patient["allocation_result"] == "INPATIENT": # existing patients
+        newdata[sid]["status"] = 2 # existing patient in inpatient departments
+    newdata[sid]["result"] = patient["allocation_result"]
+    if patient["icd_diagnose"] not in newdata[sid]["icd_code"]:
+        newdata[sid]["icd_code"][patient["icd_diagnose"]] = patient["diagnose_priority"]
+
+@profiling.timed("process")
 def process(type, data):
     newdata = {}
     for patient in data:
+        add_record(newdata, type, patient)
+    profiling.count("records", len(data))
+    profiling.count("patients read", len(newdata))
+
+    return newdata
+
+### read the newline-delimited query output one record at a time ###
+def iter_records(path):
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def _sid_order(sid):
+    # numeric order of integer ids (MIMIC subject_id), None for other ids, which are not checked
+    sid = str(sid).lstrip("0")
+    return (len(sid), sid) if sid.isdigit() else None
+
+### group the records by subject_id without holding the whole file ###
+def iter_patients(type, records):
+    # the query output is ORDER BY subject_id, so the records of one patient are contiguous
+    # and a patient is complete as soon as the next subject_id shows up
+    # only the patient being read is held; an integer subject_id lower than the previous one
+    # means the input is not sorted
+    current = {}
+    previous = None
+    for patient in records:
         sid = patient["subject_id"]
-        #type == 0: # incoming patients
-        if sid not in newdata:
-            newdata[sid] = {
-                "status": type,
-                "icd_code": {},
-                "age": patient["age"],
-                "SOFA": int(patient["sofa"]) #,random.randint(1, 24)
-            }
-        if type == 1 and patient["allocation_result"] == "INPATIENT": # existing patients
-            newdata[sid]["status"] = 2 # existing patient in inpatient departments
-        newdata[sid]["result"] = patient["allocation_result"]
-        if patient["icd_diagnose"] not in newdata[sid]["icd_code"]:
-            newdata[sid]["icd_code"][patient["icd_diagnose"]] = patient["diagnose_priority"]
+        if sid != previous:
+            order, previous_order = _sid_order(sid), _sid_order(previous)
+            if order is not None and previous_order is not None and order < previous_order:
+                raise ValueError("records of subject_id " + str(sid) + " are not contiguous, sort the input by subject_id")
+            for item in current.items():
+                yield item
+            current = {}
+            previous = sid
+        add_record(current, type, patient)
+    for item in current.items():
+        yield item
 
+### streaming version of process(), writes one compact JSON object per patient (NDJSON) ###
+@profiling.timed("process")
+def process_stream(type, path, new_filename, chunk_size=10000):
+    # chunk_size: number of patients buffered before they are written out
+    n_patients = 0
+    buffer = []
+    with open(new_filename, 'w') as f:
+        for sid, patient in iter_patients(type, iter_records(path)):
+            buffer.append(json.dumps(dict(patient, subject_id=sid), ensure_ascii=False, separators=(',', ':')))
+            n_patients += 1
+            if len(buffer) >= chunk_size:
+                f.write('\n'.join(buffer) + '\n')
+                buffer = []
+        if buffer:
+            f.write('\n'.join(buffer) + '\n')
+    profiling.count("patients read", n_patients)
+    return n_patients
 
+### load a process_stream() output into the same dict as the indented newindata.json / newexdata.json ###
+def load_ndjson(path):
+    newdata = {}
+    for patient in iter_records(path):
+        sid = patient.pop("subject_id")
+        newdata[sid] = patient
     return newdata
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default="EP_21", help="directory of incoming.json / existing.json")
+    parser.add_argument("--stream", action="store_true", help="stream the records and write NDJSON output")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="patients per write in --stream mode")
+    parser.add_argument("--profile", default=None, help="write a JSON run report of the stages to this file")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(sample_interval=0.05, dir=args.dir, stream=args.stream)
+
+    if args.stream:
+        n = process_stream(0, args.dir + '/incoming.json', args.dir + '/newindata.ndjson', args.chunk_size)
+        print("incoming patients:", n)
+        n = process_stream(1, args.dir + '/existing.json', args.dir + '/newexdata.ndjson', args.chunk_size)
+        print("existing patients:", n)
+        print("peak memory: %.1f MB" % profiling.peak_rss_mb())
+    else:
+        file = open(args.dir + '/incoming.json')
+        data = []
+        for patient_data in file.readlines():
+            data.append(json.loads(patient_data))
+        # data = json.load(file)
+        # print(data)
+        file.close()
+        newdata = process(0, data)
+        with profiling.stage("write"), open(args.dir + '/newindata.json', 'w') as f:
+            json.dump(newdata, f, ensure_ascii=False, indent=4)
+
+        file = open(args.dir + '/existing.json')
+        data = []
+        for patient_data in file.readlines():
+            data.append(json.loads(patient_data))
+        # data = json.load(file)
+        file.close()
+        newdata = process(1, data)
+        with profiling.stage("write"), open(args.dir + '/newexdata.json', 'w') as f:
+            json.dump(newdata, f, ensure_ascii=False, indent=4)
 
-    file = open('EP_21/incoming.json')
-    data = []
-    for patient_data in file.readlines():
-        data.append(json.loads(patient_data))
-    # data = json.load(file)
-    # print(data)
-    file.close()
-    newdata = process(0, data)
-    with open('EP_21/newindata.json', 'w') as f:
-        json.dump(newdata, f, ensure_ascii=False, indent=4)
-
-    file = open('EP_21/existing.json')
-    data = []
-    for patient_data in file.readlines():
-        data.append(json.loads(patient_data))
-    # data = json.load(file)
-    file.close()
-    newdata = process(1, data)
-    with open('EP_21/newexdata.json', 'w') as f:
-        json.dump(newdata, f, ensure_ascii=False, indent=4)
+    if args.profile:
+        profiling.write_report(args.profile)
+        profiling.print_report()
@@ -0,0 +1,186 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from datetime import datetime
+
+# Run instrumentation of the pipeline stages: wall time of every stage, counters (patients,
+# ICD codes, nonzeros, solver iterations, ...) and the peak memory, gathered into one JSON
+# run report. It is off by default; while off, stage() returns a shared do-nothing context
+# manager and timed() functions only test a flag, so the instrumented code runs as before.
+#
+#     profiling.enable()
+#     with profiling.stage("build"):
+#         model = build_model(...)
+#     profiling.count("patients", total)
+#     profiling.write_report("run.json")
+#
+# Stages can be nested, a nested stage is reported as "outer/inner". Only the calling
+# process is measured, work done in a process pool shows up as the time of the stage
+# around it.
+
+_enabled = False
+_stack = []
+_stages = {}
+_counters = {}
+_meta = {}
+_started = None
+_sampler = None
+
+
+def enabled():
+    return _enabled
+
+
+def peak_rss_mb():
+    # peak resident set size of the process so far, ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    # current resident set size, from /proc where available
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+class _Sampler(threading.Thread):
+    # polls the current RSS and raises the peak of every open stage, for peaks inside a stage
+    # that ru_maxrss (a peak over the whole process life) cannot attribute
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.halt = threading.Event()
+
+    def run(self):
+        while not self.halt.wait(self.interval):
+            rss = current_rss_mb()
+            for record in list(_stack):
+                if rss > record["peak"]:
+                    record["peak"] = rss
+
+
+### turn the instrumentation on, and start a new report ###
+def enable(sample_interval=None, **meta):
+    # sample_interval: seconds between two memory samples, None to only measure at stage boundaries
+    # meta: free-form fields copied into the report, e.g. census size or parameters
+    global _enabled, _started, _sampler
+    reset()
+    _meta.update(meta)
+    _started = time.perf_counter()
+    _enabled = True
+    if sample_interval:
+        _sampler = _Sampler(sample_interval)
+        _sampler.start()
+
+
+def disable():
+    global _enabled, _sampler
+    _enabled = False
+    if _sampler is not None:
+        _sampler.halt.set()
+        _sampler.join()
+        _sampler = None
+
+
+def reset():
+    global _started
+    _stack.clear()
+    _stages.clear()
+    _counters.clear()
+    _meta.clear()
+    _started = time.perf_counter()
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.record = {"name": self.name, "peak": current_rss_mb()}
+        _stack.append(self.record)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        path = "/".join(record["name"] for record in _stack)
+        _stack.pop()
+        peak = max(self.record["peak"], current_rss_mb())
+        entry = _stages.setdefault(path, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_rss_mb": 0.0})
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        entry["peak_rss_mb"] = max(entry["peak_rss_mb"], peak)
+        if _stack and peak > _stack[-1]["peak"]:
+            _stack[-1]["peak"] = peak
+        return False
+
+
+### context manager timing a stage ###
+def stage(name):
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+
+### decorator timing every call of a function as a stage ###
+def timed(name=None):
+    def decorate(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+### add to a counter, e.g. count("patients", len(data)) ###
+def count(name, n=1):
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+### the run report as a dict ###
+def report():
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "wall_seconds": time.perf_counter() - _started if _started is not None else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "meta": dict(_meta),
+        "stages": {path: dict(entry) for path, entry in _stages.items()},
+        "counters": dict(_counters),
+    }
+
+
+def write_report(path):
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=4)
+
+
+def print_report():
+    run = report()
+    print("wall time: %.3f s, peak memory: %.1f MB" % (run["wall_seconds"], run["peak_rss_mb"]))
+    for path, entry in run["stages"].items():
+        print("    %-40s calls: %6d total: %9.3f s max: %9.3f s peak: %8.1f MB"
+              % (path, entry["calls"], entry["seconds"], entry["max_seconds"], entry["peak_rss_mb"]))
+    for name, value in run["counters"].items():
+        print("    %-40s %d" % (name, value))
@@ -0,0 +1,577 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+from mdf import mdf_alloc
+from model_builder import DEFAULT_PARAMS, ICU, INPATIENT, N_UNITS, REJECT, build_model, build_objective, build_ub_rhs
+from patient_values import MAX_SOFA, compile_ep, compile_patients, priority_weights, sofa_mortality_table
+from process import load_ndjson
+from solver import UNIT_NAMES, round_allocation, solve_allocation
+from sweep import add_highs_patients, fix_highs_patient, highs_from_model, highspy, run_highs_warm
+
+# Long-running allocation service: the census, the Ep_d table and the allocation LP stay in
+# memory, and clients send events over a TCP or Unix socket, one JSON object per line:
+#   {"op": "admit", "id": "123", "patient": {"status": 0, "age": 71, "SOFA": 9, "icd_code": {"4019": "2"}}}
+#   {"op": "sofa", "id": "123", "sofa": 12}
+#   {"op": "discharge", "id": "123"}
+#   {"op": "load", "patients": {...}}        a newindata.json-like dict, admitted at once
+#   {"op": "capacity", "R_icu": 80, "R_noicu": 600}
+#   {"op": "allocation"} / {"op": "stats"}
+# and get one JSON line back per request, in order, e.g. {"ok": true, "id": "123", "unit": "icu",
+# "source": "lp", "changes": {...}} where changes lists the other patients moved by the decision
+# (the unit is "discharged" when a later event of the same batch discharged the patient).
+# Events arriving within batch_window of each other are applied together, in order, and answered
+# by one re-optimisation. The LP is kept in a HiGHS instance: an event only adds or fixes columns and
+# changes costs, so every solve is warm-started from the last basis. A solve that misses the
+# deadline is answered with the most-deteriorated-first allocation of mdf.py instead.
+
+DEADLINE = 0.05
+BATCH_WINDOW = 0.002
+MAX_BATCH = 256
+# time limit of a solve that missed the deadline and goes on in the background
+SOLVE_TIME_LIMIT = 60
+# the HiGHS model is rebuilt when more than this share of its patient slots are discharged
+COMPACT_RATIO = 0.5
+LATENCY_WINDOW = 10000
+# longest request / answer line, a "load" of a whole census is one line
+LINE_LIMIT = 2 ** 28
+
+
+### the in-memory census, one slot per patient ###
+class Census:
+    # slots are append-only until compact(); inactive slots are discharged patients
+
+    def __init__(self, Ep_d, params):
+        self.Ep_d = Ep_d
+        self.params = params
+        self.mortality = sofa_mortality_table()
+        self.ids = []
+        self.index = {}
+        self.status = np.zeros(0, dtype=np.int8)
+        self.age = np.zeros(0)
+        self.sofa = np.zeros(0, dtype=np.int8)
+        # weights @ Ep of every patient, L_p = clip(1 - M(S) + ep_term), see patient_values.py
+        self.ep_term = np.zeros((0, 2))
+        self.active = np.zeros(0, dtype=bool)
+        self.unit = np.zeros(0, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def admit(self, patients):
+        # patients: dict id -> patient in the newindata.json format; returns their slots
+        compiled = compile_patients(patients)
+        ep_term = priority_weights(compiled) @ compile_ep(self.Ep_d, compiled["icd_codes"])
+        first = len(self.ids)
+        for sid in patients:
+            self.index[sid] = len(self.ids)
+            self.ids.append(sid)
+        self.status = np.concatenate([self.status, compiled["status"]])
+        self.age = np.concatenate([self.age, compiled["age"]])
+        self.sofa = np.concatenate([self.sofa, compiled["sofa"]])
+        self.ep_term = np.concatenate([self.ep_term, ep_term])
+        self.active = np.concatenate([self.active, np.ones(len(patients), dtype=bool)])
+        # existing general inpatients stay where they are
+        self.unit = np.concatenate([self.unit, np.where(compiled["status"] == 2, INPATIENT, REJECT).astype(np.int8)])
+        return np.arange(first, len(self.ids))
+
+    def values(self, slots):
+        l_p = np.clip(1 - self.mortality[self.sofa[slots]][:, None] + self.ep_term[slots], 0, 1)
+        return self.params["w1"] * l_p + self.params["w2"] * (self.age[slots] / 100)[:, None]
+
+    def allocatable(self):
+        # existing general inpatients (status 2) keep their bed and are not allocated
+        return self.active & (self.status != 2)
+
+    def free_noicu(self):
+        return max(self.params["R_noicu"] - int((self.active & (self.status == 2)).sum()), 0)
+
+    def compact(self):
+        # drops the discharged patients, returns the old slot of every kept slot
+        keep = np.flatnonzero(self.active)
+        self.ids = [self.ids[s] for s in keep]
+        self.index = {sid: slot for slot, sid in enumerate(self.ids)}
+        for name in ("status", "age", "sofa", "ep_term", "active", "unit"):
+            setattr(self, name, getattr(self, name)[keep])
+        return keep
+
+
+### the allocation LP of the census, patched in place between solves ###
+class WarmModel:
+    # slot k of the census owns columns 4k..4k+3 and equality row 4+k, like build_model; a slot
+    # that is not allocatable has its columns fixed to 0 and its equality row set to 0 == 0
+
+    def __init__(self, census):
+        self.census = census
+        self.h = None
+        self.n_slots = 0
+        self.dirty_costs = set()
+        # while a solve runs in another thread (busy) every change waits in pending, see replay(),
+        # so that only one thread touches the model at a time
+        self.busy = False
+        self.pending = []
+
+    def rebuild(self):
+        census = self.census
+        v = census.values(np.arange(len(census)))
+        p = census.params
+        model = build_model(v[:, 0], v[:, 1], census.status, p["R_icu"], census.free_noicu(), p["Umax"],
+                            p["wl_len"], p["WL_step"], p["ew"])
+        off = ~census.allocatable()
+        model["bounds"][np.repeat(off, N_UNITS), 1] = 0
+        model["b_eq"][off] = 0
+        self.model = model
+        self.h = highs_from_model(model) if highspy is not None else None
+        self.n_slots = len(census)
+        self.dirty_costs.clear()
+
+    def add_slots(self, slots):
+        if self.h is None:
+            return
+        if self.busy:
+            self.pending.append((self.add_slots, slots))
+            return
+        total = len(slots)
+        v = self.census.values(slots)
+        p = self.census.params
+        cost = build_objective(v[:, 0], v[:, 1], self.census.status[slots], p["wl_len"], p["WL_step"], p["ew"])
+        upper = np.repeat(self.census.allocatable()[slots].astype(float), N_UNITS)
+        add_highs_patients(self.h, N_UNITS * self.n_slots, cost, upper)
+        self.n_slots += total
+
+    def remove_slot(self, slot):
+        if self.h is None:
+            return
+        if self.busy:
+            self.pending.append((self.remove_slot, slot))
+            return
+        fix_highs_patient(self.h, slot)
+        self.dirty_costs.discard(slot)
+
+    def update_costs(self, slots):
+        if self.busy:
+            self.pending.append((self.update_costs, slots))
+            return
+        self.dirty_costs.update(int(s) for s in slots)
+
+    def replay(self):
+        self.busy = False
+        pending, self.pending = self.pending, []
+        for method, arg in pending:
+            method(arg)
+
+    def prepare(self):
+        # reads the census for the next run(): the new costs of the changed slots and the
+        # right-hand side of the inequality rows; called on the thread that owns the census
+        census = self.census
+        p = census.params
+        rhs = build_ub_rhs(p["R_icu"], census.free_noicu(), p["Umax"], p["wl_len"], p["WL_step"])
+        if self.h is None:
+            # without highspy every solve is a cold linprog solve of the rebuilt model
+            self.rebuild()
+            self.model["b_ub"] = rhs
+            return None
+        slots = np.array(sorted(self.dirty_costs), dtype=int)
+        self.dirty_costs.clear()
+        v = census.values(slots)
+        cost = build_objective(v[:, 0], v[:, 1], census.status[slots], p["wl_len"], p["WL_step"], p["ew"])
+        cols = (N_UNITS * slots[:, None] + np.arange(N_UNITS)).ravel().astype(np.int32)
+        return cols, cost, rhs
+
+    def solve(self, time_limit):
+        return self.run(self.prepare(), time_limit)
+
+    def run(self, changes, time_limit):
+        # changes: from prepare(); only touches the solver, so it may run in another thread
+        if self.h is None:
+            result = solve_allocation(self.model, "linprog", time_limit=time_limit)
+            return result.x if result.status == 0 else None
+        cols, cost, rhs = changes
+        if len(cols):
+            self.h.changeColsCost(len(cols), cols, cost)
+        result = run_highs_warm(self.h, rhs, time_limit)
+        return result.x if result.success else None
+
+
+### validation of the event fields, before anything is changed ###
+def _integer(value, low, high):
+    # value (a number or a string of one, like the query output) as an int in low..high, else None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    if not number.is_integer() or not low <= number <= high:
+        return None
+    return int(number)
+
+
+def _number(value, low, high):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value if math.isfinite(value) and low <= value <= high else None
+
+
+def _patient_error(patient):
+    # the reason a patient of an admit / load event is malformed, None when it is valid
+    if not isinstance(patient, dict):
+        return "a patient must be a JSON object"
+    if _integer(patient.get("status"), 0, 2) is None:
+        return "status must be 0, 1 or 2"
+    if _integer(patient.get("age"), 0, 150) is None:
+        return "age must be an integer in 0..150"
+    if _integer(patient.get("SOFA"), 0, MAX_SOFA) is None:
+        return "SOFA must be an integer in 0..%d" % MAX_SOFA
+    codes = patient.get("icd_code")
+    if not isinstance(codes, dict) or any(_integer(p, 1, 10 ** 6) is None for p in codes.values()):
+        return "icd_code must map ICD codes to priorities >= 1"
+    return None
+
+
+# bounds of the capacity fields of a capacity event
+CAPACITY_FIELDS = {"R_icu": (0, math.inf), "R_noicu": (0, math.inf), "Umax": (0, 1)}
+
+
+def _percentile(samples, q):
+    return float(np.percentile(samples, q) * 1e3) if samples else None
+
+
+class AllocationService:
+
+    def __init__(self, Ep_d, params=None, deadline=DEADLINE, batch_window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.census = Census(Ep_d, dict(DEFAULT_PARAMS, **(params or {})))
+        self.model = WarmModel(self.census)
+        self.model.rebuild()
+        self.deadline = deadline
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queue = None
+        self.solving = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counts = {"events": 0, "batches": 0, "lp": 0, "mdf": 0}
+
+    ### apply the events of a batch to the census and the model, in order ###
+    def apply(self, events):
+        # returns one error message (or None) per event, and the census slot of the patient of
+        # every admit / sofa event (None for the other events)
+        census, model = self.census, self.model
+        errors = [None] * len(events)
+        slots = [None] * len(events)
+        # admissions are compiled together, and flushed into the census before a later event
+        # of the batch refers to one of them
+        admitted, admit_events = {}, []
+        changed = set()
+
+        def flush():
+            if not admitted:
+                return
+            try:
+                model.add_slots(census.admit(admitted))
+            except (KeyError, TypeError, ValueError) as e:
+                # a malformed patient fails the whole group of admissions
+                for i in admit_events:
+                    errors[i] = "invalid patient: " + repr(e)
+            else:
+                for i in admit_events:
+                    if events[i]["op"] == "admit":
+                        slots[i] = census.index[str(events[i]["id"])]
+            admitted.clear()
+            admit_events.clear()
+
+        for i, event in enumerate(events):
+            op = event.get("op")
+            sid = None
+            if op in ("admit", "sofa", "discharge"):
+                if isinstance(event.get("id"), bool) or not isinstance(event.get("id"), (str, int)):
+                    errors[i] = "id must be a string or an integer"
+                    continue
+                sid = str(event["id"])
+                if op != "admit" and sid in admitted:
+                    flush()
+            if op in ("admit", "load"):
+                patients = {sid: event.get("patient")} if op == "admit" else event.get("patients", {})
+                if not isinstance(patients, dict):
+                    errors[i] = "patients must be a JSON object"
+                    continue
+                duplicates = [p for p in patients if p in admitted or (p in census.index and census.active[census.index[p]])]
+                invalid = next(((p, e) for p, e in ((p, _patient_error(patients[p])) for p in patients) if e), None)
+                if duplicates:
+                    errors[i] = "already admitted: " + str(duplicates[0])
+                elif invalid:
+                    errors[i] = "invalid patient %s: %s" % invalid
+                else:
+                    admitted.update(patients)
+                    admit_events.append(i)
+            elif op in ("sofa", "discharge"):
+                slot = census.index.get(sid)
+                sofa = _integer(event.get("sofa"), 0, MAX_SOFA) if op == "sofa" else None
+                if slot is None or not census.active[slot]:
+                    errors[i] = "unknown patient: " + sid
+                elif op == "sofa" and sofa is None:
+                    errors[i] = "sofa must be an integer in 0..%d" % MAX_SOFA
+                elif op == "sofa":
+                    census.sofa[slot] = sofa
+                    changed.add(slot)
+                    slots[i] = slot
+                else:
+                    census.active[slot] = False
+                    census.unit[slot] = REJECT
+                    model.remove_slot(slot)
+                    changed.discard(slot)
+            elif op == "capacity":
+                values = {k: _number(event[k], *CAPACITY_FIELDS[k]) for k in CAPACITY_FIELDS if k in event}
+                invalid = [k for k, v in values.items() if v is None]
+                if invalid:
+                    low, high = CAPACITY_FIELDS[invalid[0]]
+                    errors[i] = invalid[0] + (" must be a number >= %g" % low if high == math.inf
+                                              else " must be a number in %g..%g" % (low, high))
+                else:
+                    census.params.update(values)
+            elif op not in ("allocation", "stats"):
+                errors[i] = "unknown op: " + str(op)
+        flush()
+        model.update_costs(changed)
+        return errors, slots
+
+    ### drop the discharged patients once they are most of the census ###
+    def compact(self):
+        # slots are renumbered, so this runs after the answers of a batch are built and not
+        # while a solve holds the model
+        census = self.census
+        if not self.model.busy and len(census) and (~census.active).sum() > COMPACT_RATIO * len(census):
+            census.compact()
+            self.model.rebuild()
+
+    ### the allocation of the whole census from an LP solution, or by MDF when x is None ###
+    def decide(self, x):
+        census = self.census
+        slots = np.flatnonzero(census.allocatable())
+        capacities = [int(census.params["R_icu"] * census.params["Umax"]), census.free_noicu()]
+        if x is not None:
+            units = round_allocation(x, slots, census.values(slots), capacities)
+            source = "lp"
+        else:
+            units = mdf_alloc(census.sofa[slots], capacities)
+            units = np.where(units == 2, REJECT, units)
+            source = "mdf"
+        previous = census.unit[slots].copy()
+        census.unit[slots] = units
+        # patients placed in ICU are existing ICU patients from now on, favoured to stay
+        new_icu = slots[(units == ICU) & (census.status[slots] == 0)]
+        census.status[new_icu] = 1
+        self.model.update_costs(new_icu)
+        moved = slots[previous != units]
+        self.counts[source] += 1
+        return source, {census.ids[s]: UNIT_NAMES[census.unit[s]] for s in moved}
+
+    def allocation(self):
+        census = self.census
+        result = {name: [] for name in UNIT_NAMES}
+        for slot in np.flatnonzero(census.allocatable()):
+            result[UNIT_NAMES[census.unit[slot]]].append(census.ids[slot])
+        return result
+
+    def stats(self):
+        samples = list(self.latencies)
+        return dict(self.counts, patients=int(self.census.active.sum()), p50_ms=_percentile(samples, 50),
+                    p99_ms=_percentile(samples, 99), max_ms=_percentile(samples, 100))
+
+    def _response(self, event, error, slot, source, changes):
+        if error is not None:
+            return {"ok": False, "error": error}
+        op = event["op"]
+        response = {"ok": True}
+        if "id" in event:
+            response["id"] = event["id"]
+        if op in ("admit", "sofa"):
+            # the patient may have been discharged by a later event of the same batch
+            census = self.census
+            response["unit"] = UNIT_NAMES[census.unit[slot]] if census.active[slot] else "discharged"
+        if op in ("admit", "sofa", "discharge", "load", "capacity"):
+            response["source"] = source
+            response["changes"] = changes
+        elif op == "allocation":
+            response["allocation"] = self.allocation()
+        elif op == "stats":
+            response["stats"] = self.stats()
+        return response
+
+    ### re-optimise, MDF when the solve misses the deadline ###
+    async def reoptimise(self):
+        if self.solving is not None or not self.census.allocatable().any():
+            # a late solve still holds the model
+            return self.decide(None)
+        loop = asyncio.get_running_loop()
+        changes = self.model.prepare()
+        self.model.busy = True
+        self.solving = loop.run_in_executor(None, self.model.run, changes, SOLVE_TIME_LIMIT)
+        self.solving.add_done_callback(self._solved)
+        try:
+            x = await asyncio.wait_for(asyncio.shield(self.solving), self.deadline)
+        except asyncio.TimeoutError:
+            # the solve goes on in the background and leaves its basis for the next one
+            return self.decide(None)
+        return self.decide(x)
+
+    def _solved(self, future):
+        self.solving = None
+        self.model.replay()
+
+    ### batching loop: apply everything that arrived within the window, solve once ###
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            end = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = end - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            events = [event for event, _, _ in batch]
+            try:
+                errors, slots = self.apply(events)
+                source, changes = None, {}
+                if any(e.get("op") not in ("allocation", "stats") for e in events):
+                    source, changes = await self.reoptimise()
+                responses = [self._response(event, error, slot, source, changes)
+                             for event, error, slot in zip(events, errors, slots)]
+            except Exception as e:
+                # fails the requests of this batch only, the service goes on with the next one
+                responses = [{"ok": False, "error": "internal error: " + repr(e)}] * len(batch)
+            self.compact()
+            self.counts["batches"] += 1
+            self.counts["events"] += len(batch)
+            for (event, future, received), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+                self.latencies.append(time.perf_counter() - received)
+
+    async def handle(self, reader, writer):
+        # requests of a connection may be pipelined, the answers keep the request order
+        pending = asyncio.Queue()
+
+        async def write_answers():
+            while True:
+                future = await pending.get()
+                if future is None:
+                    break
+                writer.write((json.dumps(await future) + "\n").encode())
+                await writer.drain()
+
+        answers = asyncio.create_task(write_answers())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                future = asyncio.get_running_loop().create_future()
+                try:
+                    event = json.loads(line)
+                    if not isinstance(event, dict):
+                        raise ValueError("not a JSON object")
+                except ValueError as e:
+                    future.set_result({"ok": False, "error": "invalid request: " + str(e)})
+                else:
+                    await self.queue.put((event, future, time.perf_counter()))
+                await pending.put(future)
+        finally:
+            await pending.put(None)
+            await answers
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765, path=None):
+        # path: Unix socket path, instead of host / port
+        self.queue = asyncio.Queue()
+        batches = asyncio.create_task(self.run_batches())
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path=path, limit=LINE_LIMIT)
+        else:
+            server = await asyncio.start_server(self.handle, host, port, limit=LINE_LIMIT)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches.cancel()
+
+
+### local client, one request at a time or pipelined with gather() ###
+class AllocationClient:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.answers = deque()
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=8765, path=None):
+        if path:
+            reader, writer = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=LINE_LIMIT)
+        return cls(reader, writer)
+
+    async def request(self, op, **fields):
+        # answers come back in request order, so each request waits for its own line
+        future = asyncio.get_running_loop().create_future()
+        async with self.lock:
+            self.writer.write((json.dumps(dict(fields, op=op)) + "\n").encode())
+            self.answers.append(future)
+        await self.writer.drain()
+        async with self.lock:
+            while not future.done():
+                line = await self.reader.readline()
+                self.answers.popleft().set_result(json.loads(line))
+        return future.result()
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def _load_census(day_dir):
+    data = {}
+    for name in ("newindata", "newexdata"):
+        path = os.path.join(day_dir, name + ".json")
+        if os.path.exists(path):
+            with open(path) as f:
+                data.update(json.load(f))
+        elif os.path.exists(os.path.join(day_dir, name + ".ndjson")):
+            data.update(load_ndjson(os.path.join(day_dir, name + ".ndjson")))
+    return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ep", default="epstats.json")
+    parser.add_argument("--census", default=None, help="extracted day directory to start from, e.g. EP_21")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="serve on this Unix socket instead of TCP")
+    parser.add_argument("--deadline", type=float, default=DEADLINE, help="seconds before falling back to MDF")
+    parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW)
+    parser.add_argument("--params", default=None, help="JSON object overriding " + ", ".join(DEFAULT_PARAMS))
+    args = parser.parse_args()
+
+    with open(args.ep) as file:
+        Ep_d_list = json.load(file)
+    service = AllocationService(Ep_d_list, json.loads(args.params) if args.params else None, args.deadline,
+                                args.batch_window)
+    if args.census:
+        census = _load_census(args.census)
+        service.apply([{"op": "load", "patients": census}])
+        source, _ = service.decide(service.model.solve(SOLVE_TIME_LIMIT))
+        print("census of %d patients loaded, first allocation by %s" % (len(census), source))
+    print("serving on " + (args.unix or "%s:%d" % (args.host, args.port)))
+    asyncio.run(service.serve(args.host, args.port, args.unix))
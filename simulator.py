@@ -0,0 +1,229 @@
+import heapq
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mdf import mdf_alloc
+from model_builder import DEFAULT_PARAMS as MODEL_PARAMS
+from model_builder import ICU, INPATIENT, N_UNITS, REJECT, WAITLIST, build_model, build_objective, build_ub_rhs
+from patient_values import calculate_l_p_all, compile_ep, compile_patients, sofa_mortality_table
+from solver import extract_allocation, round_allocation, solve_allocation
+from sweep import add_highs_patients, fix_highs_patient, highs_from_model, highspy, run_highs_warm
+
+# Rolling-horizon replay of an arrival stream: at every decision epoch (one day) the
+# new arrivals and the patients still on the waitlist are allocated by a policy, ICU
+# admissions keep their bed for their length of stay plus the bed turnaround time t,
+# and the occupancy is carried forward to the next epoch.
+#
+# arrivals use the census format of process.py (newindata.json), with two more fields:
+#   "arrival_day": index of the decision epoch the patient arrives at (0, 1, 2, ...)
+#   "los": ICU length of stay in days (default_los when missing)
+
+DEFAULT_LOS = 3
+# the epoch model is rebuilt when more than this share of its patients are decided
+COMPACT_RATIO = 0.5
+
+DEFAULT_PARAMS = dict(
+    MODEL_PARAMS,
+    policy="lp",
+    t=0,  # bed turnaround time of ICU patients reallocation, in days
+    max_wait=3,  # epochs a patient may stay on the waitlist before it counts as rejected
+    time_limit=5,  # seconds per LP solve
+)
+
+
+### arrival stream from several extracted days, e.g. ["EP_20", "EP_21", ...], in order ###
+def arrivals_from_days(day_dirs, filename="newindata.json"):
+    arrivals = {}
+    for day, day_dir in enumerate(day_dirs):
+        with open(os.path.join(day_dir, filename)) as file:
+            for sid, patient in json.load(file).items():
+                arrivals[sid] = dict(patient, arrival_day=day)
+    return arrivals
+
+
+### compile the arrival stream once, the scenarios only re-weight it ###
+def compile_arrivals(arrivals, Ep_d, mortality_table=None, default_los=DEFAULT_LOS):
+    sids = sorted(arrivals, key=lambda sid: arrivals[sid]["arrival_day"])
+    compiled = compile_patients(arrivals, sids)
+    ep_table = compile_ep(Ep_d, compiled["icd_codes"])
+    # L_p does not depend on the scenario parameters, V_p = w1 * L_p + w2 * age / 100 does
+    if mortality_table is None:
+        mortality_table = sofa_mortality_table()
+    compiled["l_p"] = calculate_l_p_all(compiled, ep_table, mortality_table)
+    compiled["arrival_day"] = np.array([int(arrivals[sid]["arrival_day"]) for sid in sids])
+    compiled["los"] = np.array([float(arrivals[sid].get("los", default_los)) for sid in sids])
+    return compiled
+
+
+### the allocation LP of a replay, carried from one epoch to the next ###
+class EpochModel:
+    # every candidate owns 4 columns and an equality row from the epoch it arrives at until it is
+    # decided; a decided patient is fixed to 0, so the basis of the last epoch stays a warm start
+
+    def __init__(self):
+        self.h = None
+        self.slots = {}
+        self.n_slots = 0
+
+    def _costs(self, v, params):
+        status = np.zeros(len(v), dtype=np.int8)
+        return build_objective(v[:, 0], v[:, 1], status, params["wl_len"], params["WL_step"], params["ew"])
+
+    def solve(self, candidates, v, free_icu, free_noicu, params):
+        # returns the unit of every candidate, None when HiGHS found no solution in time
+        live = set(candidates.tolist())
+        decided = [p for p in self.slots if p not in live]
+        if self.h is None or len(decided) + self.n_slots - len(self.slots) > COMPACT_RATIO * self.n_slots:
+            model = build_model(v[:, 0], v[:, 1], np.zeros(len(v), dtype=np.int8), free_icu, free_noicu, 1.0,
+                                params["wl_len"], params["WL_step"], params["ew"])
+            self.h = highs_from_model(model)
+            self.slots = {p: slot for slot, p in enumerate(candidates.tolist())}
+            self.n_slots = len(candidates)
+        else:
+            for p in decided:
+                fix_highs_patient(self.h, self.slots.pop(p))
+            new = np.array([i for i, p in enumerate(candidates.tolist()) if p not in self.slots], dtype=int)
+            if len(new):
+                add_highs_patients(self.h, N_UNITS * self.n_slots, self._costs(v[new], params),
+                                   np.ones(N_UNITS * len(new)))
+                for i in new:
+                    self.slots[int(candidates[i])] = self.n_slots
+                    self.n_slots += 1
+        rhs = build_ub_rhs(free_icu, free_noicu, 1.0, params["wl_len"], params["WL_step"])
+        result = run_highs_warm(self.h, rhs, params["time_limit"])
+        if not result.success:
+            return None
+        slots = np.array([self.slots[p] for p in candidates.tolist()], dtype=int)
+        return round_allocation(result.x, slots, v, [free_icu, free_noicu])
+
+
+### policies: allocate the candidates of one epoch to ICU / INPATIENT / WAITLIST / REJECT ###
+def lp_policy(v, sofa, free_icu, free_noicu, params, candidates=None, state=None):
+    # candidates / state: patient indices of the rows of v and the dict simulate() keeps over
+    # the epochs of a replay; with highspy the LP of the last epoch is warm-started, otherwise
+    # every epoch is an integer program solved from scratch
+    if highspy is not None and state is not None:
+        units = state.setdefault("model", EpochModel()).solve(candidates, v, free_icu, free_noicu, params)
+        # without a solution the epoch is allocated by MDF
+        return mdf_policy(v, sofa, free_icu, free_noicu, params) if units is None else units
+    status = np.zeros(len(v), dtype=np.int8)
+    model = build_model(v[:, 0], v[:, 1], status, free_icu, free_noicu, 1.0,
+                        params["wl_len"], params["WL_step"], params["ew"])
+    result = solve_allocation(model, "milp", time_limit=params["time_limit"])
+    if result.x is None:
+        return mdf_policy(v, sofa, free_icu, free_noicu, params)
+    allocation = extract_allocation(result.x)
+    units = np.full(len(v), REJECT)
+    for unit, name in ((ICU, "icu"), (INPATIENT, "general inpatient"), (WAITLIST, "icu waitlist")):
+        units[allocation[name]] = unit
+    return units
+
+
+def mdf_policy(v, sofa, free_icu, free_noicu, params, candidates=None, state=None):
+    # most deteriorated first: the highest SOFA scores get the free ICU beds, then the general beds
+    units = mdf_alloc(sofa, [free_icu, free_noicu])
+    units[units == 2] = REJECT
+    return units
+
+
+POLICIES = {
+    "lp": lp_policy,
+    "mdf": mdf_policy,
+}
+
+
+### replay the arrival stream under one parameter setting ###
+def simulate(compiled, params=None):
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    policy = POLICIES[params["policy"]]
+    age = compiled["age"] / 100
+    l_p = compiled["l_p"]
+    sofa = compiled["sofa"]
+    arrival_day = compiled["arrival_day"]
+    n_epochs = int(arrival_day.max()) + 1 if len(arrival_day) else 0
+    # first arrival of every epoch, the arrivals are sorted by arrival_day
+    first = np.searchsorted(arrival_day, np.arange(n_epochs + 1))
+    icu_beds = int(params["R_icu"] * params["Umax"])
+
+    state = {}  # solver state of the policy, kept over the epochs
+    releases = []  # min-heap of the days the occupied ICU beds become free again
+    waitlist = np.zeros(0, dtype=np.int64)
+    waited = np.zeros(len(age), dtype=np.int64)
+    outcome = np.full(len(age), -1)
+    epochs = {"occupied": [], "waitlist": [], "admitted": [], "rejected": [], "survival": []}
+    for day in range(n_epochs):
+        while releases and releases[0] <= day:
+            heapq.heappop(releases)
+        candidates = np.concatenate([waitlist, np.arange(first[day], first[day + 1])])
+        free_icu = max(icu_beds - len(releases), 0)
+        v = params["w1"] * l_p[candidates] + params["w2"] * age[candidates, None]
+        if len(candidates):
+            units = policy(v, sofa[candidates], free_icu, params["R_noicu"], params, candidates, state)
+        else:
+            units = np.zeros(0, dtype=np.int64)
+
+        admitted = candidates[units == ICU]
+        for p in admitted:
+            heapq.heappush(releases, day + math.ceil(compiled["los"][p] + params["t"]))
+        waitlist = candidates[units == WAITLIST]
+        waited[waitlist] += 1
+        expired = waitlist[waited[waitlist] > params["max_wait"]]
+        waitlist = waitlist[waited[waitlist] <= params["max_wait"]]
+        outcome[admitted] = ICU
+        outcome[candidates[units == INPATIENT]] = INPATIENT
+        outcome[candidates[units == REJECT]] = REJECT
+        outcome[expired] = REJECT
+
+        # expected survival of the patients decided in this epoch, rejected patients count 0
+        survival = l_p[admitted, 0].sum() + l_p[candidates[units == INPATIENT], 1].sum()
+        epochs["occupied"].append(len(releases))
+        epochs["waitlist"].append(len(waitlist))
+        epochs["admitted"].append(len(admitted))
+        epochs["rejected"].append(int((units == REJECT).sum()) + len(expired))
+        epochs["survival"].append(survival)
+
+    epochs = {key: np.array(values) for key, values in epochs.items()}
+    summary = {
+        "epochs": n_epochs,
+        "patients": len(age),
+        "mean_utilisation": float(epochs["occupied"].mean() / params["R_icu"]) if n_epochs else 0.0,
+        "peak_utilisation": float(epochs["occupied"].max() / params["R_icu"]) if n_epochs else 0.0,
+        "mean_waitlist": float(epochs["waitlist"].mean()) if n_epochs else 0.0,
+        "max_waitlist": int(epochs["waitlist"].max()) if n_epochs else 0,
+        "icu": int((outcome == ICU).sum()),
+        "inpatient": int((outcome == INPATIENT).sum()),
+        "rejected": int((outcome == REJECT).sum()),
+        # still on the waitlist when the replay ends
+        "waiting": len(waitlist),
+        "expected_survival": float(epochs["survival"].sum()),
+    }
+    return summary, epochs
+
+
+### scenarios in parallel: every worker compiles the arrival stream once ###
+_worker_compiled = None
+
+
+def _init_worker(arrivals, Ep_d):
+    global _worker_compiled
+    _worker_compiled = compile_arrivals(arrivals, Ep_d)
+
+
+def _run_scenario(params):
+    summary, _ = simulate(_worker_compiled, params)
+    return dict(params, **summary)
+
+
+def run_scenarios(arrivals, Ep_d, scenarios, workers=None):
+    # scenarios: list of parameter dicts overriding DEFAULT_PARAMS, e.g. sweep.grid_points(...)
+    # returns one dict per scenario: its parameters and the summary of simulate()
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        _init_worker(arrivals, Ep_d)
+        return [_run_scenario(params) for params in scenarios]
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(arrivals, Ep_d)) as pool:
+        return list(pool.map(_run_scenario, scenarios))
@@ -0,0 +1,331 @@
+import argparse
+import csv
+import os
+
+import numpy as np
+
+# Local, vectorized version of the SOFA part of query_updated.sql: the vaso_stg / vaso_mv,
+# pafi1 / pafi2, scorecomp, scorecalc, patient_sofa and patient_sofa_corrected CTEs,
+# computed from the exported MIMIC tables instead of BigQuery.
+#
+# Every table is a CSV or Parquet file named after the MIMIC table, with the MIMIC column names:
+#   icustays                 subject_id, hadm_id, stay_id, intime
+#   norepinephrine, epinephrine, dobutamine, dopamine
+#                            stay_id, starttime, vaso_rate
+#   bg                       subject_id, charttime, pao2fio2ratio
+#   ventilation              stay_id, starttime, endtime, ventilation_status
+#   first_day_vitalsign      stay_id, mbp_min
+#   first_day_lab            stay_id, creatinine_max, bilirubin_total_max, platelets_min
+#   first_day_urine_output   stay_id, urineoutput
+#   first_day_gcs            stay_id, gcs_min
+# Missing tables are treated as empty, and missing values (NULL) are NaN, which compares
+# False like NULL does in a SQL CASE.
+
+VASOPRESSORS = ("norepinephrine", "epinephrine", "dobutamine", "dopamine")
+TABLES = ("icustays",) + VASOPRESSORS + ("bg", "ventilation", "first_day_vitalsign", "first_day_lab",
+                                         "first_day_urine_output", "first_day_gcs")
+COMPONENTS = ("respiration", "coagulation", "liver", "cardiovascular", "cns", "renal")
+
+# window of the first-day measurements: [intime - 6 hours, intime + 1 day]
+WINDOW_BEFORE = np.timedelta64(6, 'h')
+WINDOW_AFTER = np.timedelta64(1, 'D')
+# stay index * TIME_STRIDE + seconds keeps the times of different stays apart (2**34 s > 500 years)
+TIME_STRIDE = 2 ** 34
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # CSV only
+    pq = None
+
+
+### reading the exported tables ###
+def read_table(path):
+    # returns {column name: numpy array of strings, '' for NULL}
+    if path.endswith(".parquet"):
+        if pq is None:
+            raise ImportError("reading Parquet files needs pyarrow, export the table as CSV instead")
+        table = pq.read_table(path).to_pydict()
+        return {name.lower(): np.array(["" if v is None else str(v) for v in values])
+                for name, values in table.items()}
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        header = [name.lower() for name in next(reader)]
+        rows = list(reader)
+    if not rows:
+        return {name: np.array([], dtype=str) for name in header}
+    columns = np.array(rows, dtype=str).T
+    return dict(zip(header, columns))
+
+
+def load_tables(directory):
+    tables = {}
+    for name in TABLES:
+        for extension in (".csv", ".parquet"):
+            path = os.path.join(directory, name + extension)
+            if os.path.exists(path):
+                tables[name] = read_table(path)
+                break
+    return tables
+
+
+def _num(column):
+    column = np.asarray(column)
+    if column.dtype.kind in "fiu":
+        return column.astype(float)
+    return np.where(column == "", "nan", column).astype(float)
+
+
+def _time(column):
+    column = np.asarray(column)
+    if column.dtype.kind == "M":
+        return column.astype("datetime64[s]")
+    return np.char.replace(column.astype(str), " ", "T").astype("datetime64[s]")
+
+
+def _ids(column):
+    return np.asarray(column).astype(np.int64)
+
+
+### per-stay aggregates ###
+def _stay_index(stay_ids, column):
+    # position of every row's stay_id in stay_ids (sorted), -1 when the stay is unknown
+    ids = _ids(column)
+    pos = np.searchsorted(stay_ids, ids)
+    pos = np.minimum(pos, len(stay_ids) - 1) if len(stay_ids) else pos
+    found = (stay_ids[pos] == ids) if len(stay_ids) else np.zeros(len(ids), dtype=bool)
+    return np.where(found, pos, -1)
+
+
+def _group_reduce(reduce, n, index, values):
+    # reduce = np.fmax / np.fmin, ignores NaN like SQL MAX / MIN ignore NULL
+    out = np.full(n, np.nan)
+    keep = index >= 0
+    reduce.at(out, index[keep], values[keep])
+    return out
+
+
+def _first_day_column(tables, table, column, stay_ids):
+    if table not in tables:
+        return np.full(len(stay_ids), np.nan)
+    t = tables[table]
+    # one row per stay in the first_day_* tables, max() only picks it up
+    return _group_reduce(np.fmax, len(stay_ids), _stay_index(stay_ids, t["stay_id"]), _num(t[column]))
+
+
+def _in_window(times, intime):
+    return (times >= intime - WINDOW_BEFORE) & (times <= intime + WINDOW_AFTER)
+
+
+### vaso_stg + vaso_mv: max rate of every vasopressor started in the first-day window ###
+def vasopressor_rates(tables, stay_ids, intime):
+    rates = {}
+    for treatment in VASOPRESSORS:
+        rates[treatment] = np.full(len(stay_ids), np.nan)
+        if treatment not in tables:
+            continue
+        t = tables[treatment]
+        index = _stay_index(stay_ids, t["stay_id"])
+        starttime = _time(t["starttime"])
+        keep = index >= 0
+        keep[keep] = _in_window(starttime[keep], intime[index[keep]])
+        rates[treatment] = _group_reduce(np.fmax, len(stay_ids), np.where(keep, index, -1), _num(t["vaso_rate"]))
+    return rates
+
+
+### pafi1 + pafi2: lowest PaO2/FiO2 with and without invasive ventilation ###
+def pao2fio2_min(tables, stay_ids, subject_ids, intime):
+    n = len(stay_ids)
+    novent = np.full(n, np.nan)
+    vent = np.full(n, np.nan)
+    if "bg" not in tables or n == 0:
+        return novent, vent
+    bg = tables["bg"]
+    # blood gases join the stays on subject_id: every bg row meets every stay of its subject
+    by_subject = np.argsort(subject_ids, kind="stable")
+    sorted_subjects = subject_ids[by_subject]
+    bg_subject = _ids(bg["subject_id"])
+    lo = np.searchsorted(sorted_subjects, bg_subject, side="left")
+    hi = np.searchsorted(sorted_subjects, bg_subject, side="right")
+    counts = hi - lo
+    bg_rows = np.repeat(np.arange(len(bg_subject)), counts)
+    offsets = np.arange(len(bg_rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    stays = by_subject[np.repeat(lo, counts) + offsets]
+    charttime = _time(bg["charttime"])[bg_rows]
+    keep = _in_window(charttime, intime[stays])
+    stays, charttime, bg_rows = stays[keep], charttime[keep], bg_rows[keep]
+    ratio = _num(bg["pao2fio2ratio"])[bg_rows]
+
+    is_vent = np.zeros(len(stays), dtype=bool)
+    if "ventilation" in tables and len(stays):
+        vd = tables["ventilation"]
+        v_index = _stay_index(stay_ids, vd["stay_id"])
+        v_keep = (v_index >= 0) & (np.asarray(vd["ventilation_status"]) == "InvasiveVent")
+        v_index = v_index[v_keep]
+        start = _time(vd["starttime"])[v_keep].astype(np.int64) + v_index * TIME_STRIDE
+        end = _time(vd["endtime"])[v_keep].astype(np.int64) + v_index * TIME_STRIDE
+        order = np.argsort(start, kind="stable")
+        start = start[order]
+        # latest end among the intervals starting before t: t is inside one of them iff it is >= t;
+        # the stride keeps the ends of earlier stays below every time of the current stay
+        end = np.maximum.accumulate(end[order]) if len(end) else end
+        query = charttime.astype(np.int64) + stays * TIME_STRIDE
+        pos = np.searchsorted(start, query, side="right") - 1
+        valid = pos >= 0
+        is_vent[valid] = end[pos[valid]] >= query[valid]
+
+    novent = _group_reduce(np.fmin, n, np.where(~is_vent, stays, -1), ratio)
+    vent = _group_reduce(np.fmin, n, np.where(is_vent, stays, -1), ratio)
+    return novent, vent
+
+
+### scorecomp: the inputs of every component, one row per ICU stay ###
+def score_components(tables):
+    icu = tables["icustays"]
+    order = np.argsort(_ids(icu["stay_id"]), kind="stable")
+    stay_ids = _ids(icu["stay_id"])[order]
+    subject_ids = _ids(icu["subject_id"])[order]
+    hadm_ids = _ids(icu["hadm_id"])[order] if "hadm_id" in icu else np.full(len(order), -1)
+    intime = _time(icu["intime"])[order]
+    rates = vasopressor_rates(tables, stay_ids, intime)
+    novent, vent = pao2fio2_min(tables, stay_ids, subject_ids, intime)
+    return {
+        "stay_id": stay_ids,
+        "subject_id": subject_ids,
+        "hadm_id": hadm_ids,
+        "mbp_min": _first_day_column(tables, "first_day_vitalsign", "mbp_min", stay_ids),
+        "rate_norepinephrine": rates["norepinephrine"],
+        "rate_epinephrine": rates["epinephrine"],
+        "rate_dopamine": rates["dopamine"],
+        "rate_dobutamine": rates["dobutamine"],
+        "creatinine_max": _first_day_column(tables, "first_day_lab", "creatinine_max", stay_ids),
+        "bilirubin_max": _first_day_column(tables, "first_day_lab", "bilirubin_total_max", stay_ids),
+        "platelet_min": _first_day_column(tables, "first_day_lab", "platelets_min", stay_ids),
+        "pao2fio2_novent_min": novent,
+        "pao2fio2_vent_min": vent,
+        "urineoutput": _first_day_column(tables, "first_day_urine_output", "urineoutput", stay_ids),
+        "gcs_min": _first_day_column(tables, "first_day_gcs", "gcs_min", stay_ids),
+    }
+
+
+def _case(conditions, choices, null):
+    # CASE WHEN ... END: the first true condition wins, NaN (NULL) when only `null` holds
+    return np.select(conditions + [null], choices + [np.nan], default=0.0)
+
+
+### scorecalc: the six component scores, NaN when the underlying data is missing ###
+def score_calc(c):
+    vent, novent = c["pao2fio2_vent_min"], c["pao2fio2_novent_min"]
+    platelet, bilirubin = c["platelet_min"], c["bilirubin_max"]
+    dopamine, epinephrine = c["rate_dopamine"], c["rate_epinephrine"]
+    norepinephrine, dobutamine, mbp = c["rate_norepinephrine"], c["rate_dobutamine"], c["mbp_min"]
+    gcs, creatinine, urine = c["gcs_min"], c["creatinine_max"], c["urineoutput"]
+    return {
+        "respiration": _case(
+            [vent < 100, vent < 200, novent < 300, novent < 400], [4, 3, 2, 1],
+            np.isnan(vent) & np.isnan(novent)),
+        "coagulation": _case(
+            [platelet < 20, platelet < 50, platelet < 100, platelet < 150], [4, 3, 2, 1],
+            np.isnan(platelet)),
+        "liver": _case(
+            [bilirubin >= 12.0, bilirubin >= 6.0, bilirubin >= 2.0, bilirubin >= 1.2], [4, 3, 2, 1],
+            np.isnan(bilirubin)),
+        # as in the query, any epinephrine / norepinephrine rate <= 0.1 scores 3
+        "cardiovascular": _case(
+            [(dopamine > 15) | (epinephrine > 0.1) | (norepinephrine > 0.1),
+             (dopamine > 5) | (epinephrine <= 0.1) | (norepinephrine <= 0.1),
+             (dopamine > 0) | (dobutamine > 0),
+             mbp < 70], [4, 3, 2, 1],
+            np.isnan(mbp) & np.isnan(dopamine) & np.isnan(dobutamine) & np.isnan(epinephrine)
+            & np.isnan(norepinephrine)),
+        "cns": _case(
+            [(gcs >= 13) & (gcs <= 14), (gcs >= 10) & (gcs <= 12), (gcs >= 6) & (gcs <= 9), gcs < 6], [1, 2, 3, 4],
+            np.isnan(gcs)),
+        "renal": _case(
+            [creatinine >= 5.0, urine < 200, (creatinine >= 3.5) & (creatinine < 5.0), urine < 500,
+             (creatinine >= 2.0) & (creatinine < 3.5), (creatinine >= 1.2) & (creatinine < 2.0)], [4, 4, 3, 3, 2, 1],
+            np.isnan(urine) & np.isnan(creatinine)),
+    }
+
+
+### patient_sofa: SOFA of every ICU stay, missing components count 0 ###
+def compute_sofa(tables):
+    components = score_components(tables)
+    scores = score_calc(components)
+    stays = {"stay_id": components["stay_id"], "subject_id": components["subject_id"],
+             "hadm_id": components["hadm_id"]}
+    stays["SOFA"] = sum(np.nan_to_num(scores[name]) for name in COMPONENTS).astype(np.int64) \
+        if len(components["stay_id"]) else np.zeros(0, dtype=np.int64)
+    stays.update(scores)
+    return stays
+
+
+### patient_sofa_corrected: MAX(SOFA) of every subject ###
+def subject_sofa(stays):
+    # subjects without an ICU stay are not listed, the query gives them a SOFA of 1
+    subjects, index = np.unique(stays["subject_id"], return_inverse=True)
+    sofa = np.zeros(len(subjects), dtype=np.int64)
+    np.maximum.at(sofa, index, stays["SOFA"])
+    return subjects, sofa
+
+
+def _cell(value):
+    # the CSV text of a score, '' for NULL
+    if isinstance(value, float):
+        return "" if np.isnan(value) else str(int(value))
+    return str(value)
+
+
+### compare with the query output on a fixture, e.g. fixtures/sofa ###
+def check_expected(directory):
+    # directory holds the tables, and expected_stays.csv / expected_sofa.csv written from
+    # the query itself (fixtures/sofa/make_expected.py); returns a list of the mismatches
+    stays = compute_sofa(load_tables(directory))
+    subjects, sofa = subject_sofa(stays)
+    columns = ["subject_id", "hadm_id", "stay_id", "SOFA"] + list(COMPONENTS)
+    computed = {
+        "expected_stays.csv": [[_cell(v) for v in row] for row in zip(*(stays[name].tolist() for name in columns))],
+        "expected_sofa.csv": [[str(a), str(b)] for a, b in zip(subjects.tolist(), sofa.tolist())],
+    }
+    mismatches = []
+    for name, rows in computed.items():
+        with open(os.path.join(directory, name), newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            expected = list(reader)
+        if len(expected) != len(rows):
+            mismatches.append("%s: %d rows expected, %d computed" % (name, len(expected), len(rows)))
+        for want, got in zip(expected, rows):
+            if want != got:
+                mismatches.append("%s: expected %s, computed %s" % (name, dict(zip(header, want)), dict(zip(header, got))))
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tables", help="directory of the exported tables (CSV or Parquet)")
+    parser.add_argument("--out", default="sofa.csv", help="subject_id, sofa per subject")
+    parser.add_argument("--stays", default=None, help="also write the per-stay component scores")
+    parser.add_argument("--check", action="store_true",
+                        help="compare with expected_stays.csv / expected_sofa.csv of the tables directory instead")
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches = check_expected(args.tables)
+        for line in mismatches:
+            print(line)
+        print("%d mismatches" % len(mismatches))
+        raise SystemExit(1 if mismatches else 0)
+
+    stays = compute_sofa(load_tables(args.tables))
+    subjects, sofa = subject_sofa(stays)
+    with open(args.out, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["subject_id", "sofa"])
+        writer.writerows(zip(subjects.tolist(), sofa.tolist()))
+    if args.stays:
+        columns = ["subject_id", "hadm_id", "stay_id", "SOFA"] + list(COMPONENTS)
+        with open(args.stays, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in zip(*(stays[name].tolist() for name in columns)):
+                writer.writerow([_cell(v) for v in row])
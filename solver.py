@@ -0,0 +1,106 @@
+import numpy as np
+from scipy.optimize import Bounds, LinearConstraint, OptimizeResult, linprog, milp
+
+import profiling
+from model_builder import ICU, INPATIENT, N_UNITS, REJECT, WAITLIST
+
+# columns of a patient in the decision vector, see model_builder.py
+UNIT_NAMES = ["icu", "general inpatient", "icu waitlist", "rejection"]
+
+
+### integer solve with scipy.optimize.milp (HiGHS branch and bound) ###
+def _solve_milp(model, time_limit=None, mip_rel_gap=None, accept_incumbent=True):
+    # accept_incumbent: when the time limit is hit, return the best integral solution found so far
+    n = len(model["c"])
+    constraints = [
+        LinearConstraint(model["A_ub"], -np.inf, model["b_ub"]),
+        LinearConstraint(model["A_eq"], model["b_eq"], model["b_eq"]),
+    ]
+    options = {"disp": False}
+    if time_limit is not None:
+        options["time_limit"] = time_limit
+    if mip_rel_gap is not None:
+        options["mip_rel_gap"] = mip_rel_gap
+    bounds = np.asarray(model["bounds"], dtype=float)
+    result = milp(model["c"], integrality=np.ones(n), bounds=Bounds(bounds[:, 0], bounds[:, 1]),
+                  constraints=constraints, options=options)
+    # milp reports status 1 when a limit was reached, with or without an incumbent
+    if result.status != 0 and not (accept_incumbent and result.x is not None):
+        result.x = None
+    return result
+
+
+### LP relaxation with scipy.optimize.linprog, the solve of the original notebook ###
+def _solve_linprog(model, method="highs-ds", time_limit=None):
+    options = {}
+    if time_limit is not None and method.startswith("highs"):
+        options["time_limit"] = time_limit
+    return linprog(**model, method=method, options=options)
+
+
+# solver backends: name -> function(model, **options) returning a scipy OptimizeResult
+BACKENDS = {
+    "milp": _solve_milp,
+    "linprog": _solve_linprog,
+}
+
+
+def register_backend(name, solve):
+    BACKENDS[name] = solve
+
+
+### solve an allocation model built by model_builder.build_model ###
+def solve_allocation(model, backend="milp", **options):
+    if backend not in BACKENDS:
+        raise ValueError("unknown solver backend: " + str(backend) + ", choose from " + str(list(BACKENDS)))
+    with profiling.stage("solve"):
+        result = BACKENDS[backend](model, **options)
+    if not isinstance(result, OptimizeResult):
+        result = OptimizeResult(result)
+    count_iterations(result)
+    return result
+
+
+def count_iterations(result):
+    # simplex iterations of the LP solvers, branch and bound nodes of milp
+    profiling.count("solves")
+    profiling.count("solver iterations", result.get("nit") or 0)
+    profiling.count("mip nodes", result.get("mip_node_count") or 0)
+
+
+### translate a solution vector into the allocation of every patient ###
+@profiling.timed("extract")
+def extract_allocation(x, p_num=None, tol=1e-6):
+    # p_num: the patient number of every row of the model, defaults to the row index
+    # a patient is in "allocation error" unless its columns are integral (up to tol) with exactly one 1
+    result = {name: [] for name in UNIT_NAMES}
+    result["allocation error"] = []
+    if x is None:
+        return result
+    x = np.asarray(x).reshape(-1, N_UNITS)
+    X = np.rint(x)
+    valid = (X.sum(axis=1) == 1) & (np.abs(x - X) <= tol).all(axis=1)
+    unit = X.argmax(axis=1)
+    labels = np.arange(len(X)) if p_num is None else np.asarray(p_num)
+    for u, name in enumerate(UNIT_NAMES):
+        result[name] = labels[valid & (unit == u)].tolist()
+    result["allocation error"] = labels[~valid].tolist()
+    return result
+
+
+### integral units from an LP solution, the few fractional patients are rounded greedily ###
+def round_allocation(x, slots, values, capacities, tol=1e-6):
+    # slots: the patients (rows of the model) to allocate, values: their (V_ICU, V_non-ICU)
+    # capacities: [ICU beds, general beds], the waitlist shares the general beds
+    x = np.asarray(x).reshape(-1, N_UNITS)[slots]
+    X = np.rint(x)
+    valid = (X.sum(axis=1) == 1) & (np.abs(x - X) <= tol).all(axis=1)
+    units = np.where(valid, X.argmax(axis=1), REJECT)
+    free_icu = capacities[0] - int((units == ICU).sum())
+    free_noicu = capacities[1] - int(((units == INPATIENT) | (units == WAITLIST)).sum())
+    for i in np.flatnonzero(~valid)[np.argsort(-values[~valid, 0], kind="stable")]:
+        if free_icu > 0:
+            units[i], free_icu = ICU, free_icu - 1
+        elif free_noicu > 0:
+            units[i], free_noicu = INPATIENT, free_noicu - 1
+    return units
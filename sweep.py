@@ -0,0 +1,144 @@
+import numpy as np
+from scipy import sparse
+from scipy.optimize import OptimizeResult
+
+from model_builder import ICU, INPATIENT, N_UNITS, REJECT, WAITLIST, build_model, build_ub_rhs, waitlist_factor
+import profiling
+from solver import count_iterations, solve_allocation
+
+try:
+    import highspy
+except ImportError:  # without highspy every point of the sweep is a cold linprog solve
+    highspy = None
+
+# parameters that the sweep may vary, see model_builder.build_model
+SWEEP_PARAMS = ("R_icu", "R_noicu", "Umax", "wl_len", "WL_step", "ew")
+# inequality rows of build_model, the equality row of patient p is row N_UB_ROWS + p
+N_UB_ROWS = 4
+
+
+### the points of the waitlist-length loop in model.ipynb ###
+def waitlist_points(WL_max, WL_step):
+    return [{"wl_len": wl_len} for wl_len in range(0, WL_max+1, WL_step)]
+
+
+### every combination of the given parameter values, e.g. grid_points(Umax=[0.8, 0.9], ew=[0.9, 0.99]) ###
+def grid_points(**values):
+    points = [{}]
+    for name, options in values.items():
+        points = [dict(point, **{name: option}) for point in points for option in options]
+    return points
+
+
+def highs_from_model(model):
+    # the inequality rows come first, then one equality row per patient
+    A = sparse.vstack([model["A_ub"], model["A_eq"]]).tocsc()
+    n_ub = model["A_ub"].shape[0]
+    inf = highspy.kHighsInf
+    lp = highspy.HighsLp()
+    lp.num_col_ = A.shape[1]
+    lp.num_row_ = A.shape[0]
+    lp.col_cost_ = model["c"]
+    lp.col_lower_ = model["bounds"][:, 0]
+    lp.col_upper_ = model["bounds"][:, 1]
+    lp.row_lower_ = np.concatenate([np.full(n_ub, -inf), model["b_eq"]])
+    lp.row_upper_ = np.concatenate([model["b_ub"], model["b_eq"]])
+    lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+    lp.a_matrix_.start_ = A.indptr
+    lp.a_matrix_.index_ = A.indices
+    lp.a_matrix_.value_ = A.data
+    h = highspy.Highs()
+    h.setOptionValue("output_flag", False)
+    h.passModel(lp)
+    return h
+
+
+def add_highs_patients(h, first_col, cost, upper):
+    # appends the 4 columns and the equality row of len(cost) / 4 patients to a model of
+    # highs_from_model whose columns end at first_col; upper: 0 to fix a patient out, else 1
+    total = len(cost) // N_UNITS
+    # column entries in the inequality rows, see model_builder.build_ub
+    col_rows = {ICU: [0], INPATIENT: [1], WAITLIST: [1, 2, 3], REJECT: []}
+    col_vals = {ICU: [1.0], INPATIENT: [1.0], WAITLIST: [1.0, 1.0, -1.0], REJECT: []}
+    starts, index, value = [], [], []
+    for _ in range(total):
+        for unit in range(N_UNITS):
+            starts.append(len(index))
+            index += col_rows[unit]
+            value += col_vals[unit]
+    upper = np.asarray(upper, dtype=float)
+    h.addCols(total * N_UNITS, cost, np.zeros(total * N_UNITS), upper, len(index),
+              np.array(starts, dtype=np.int32), np.array(index, dtype=np.int32), np.array(value))
+    cols = np.arange(first_col, first_col + total * N_UNITS, dtype=np.int32)
+    rhs = upper[::N_UNITS]
+    h.addRows(total, rhs, rhs, len(cols), np.arange(0, len(cols), N_UNITS, dtype=np.int32), cols, np.ones(len(cols)))
+
+
+def fix_highs_patient(h, slot):
+    # fixes the columns of patient slot of a model of highs_from_model to 0 and its equality
+    # row to 0 == 0, so the patient leaves the LP but the basis of the last run stays valid
+    cols = np.arange(N_UNITS * slot, N_UNITS * slot + N_UNITS, dtype=np.int32)
+    h.changeColsBounds(N_UNITS, cols, np.zeros(N_UNITS), np.zeros(N_UNITS))
+    h.changeRowBounds(N_UB_ROWS + slot, 0, 0)
+
+
+def run_highs(h):
+    # Highs keeps the basis of the previous run, so after a cost / bound change this is a warm start
+    with profiling.stage("solve"):
+        h.run()
+    info = h.getInfo()
+    model_status = h.getModelStatus()
+    success = model_status == highspy.HighsModelStatus.kOptimal
+    result = OptimizeResult(
+        x=np.array(h.getSolution().col_value),
+        fun=info.objective_function_value,
+        success=success,
+        status=0 if success else 2,
+        message=h.modelStatusToString(model_status),
+        nit=info.simplex_iteration_count,
+    )
+    count_iterations(result)
+    return result
+
+
+def run_highs_warm(h, ub_rhs, time_limit):
+    # run_highs of a model kept over several solves, with the right-hand side ub_rhs of the
+    # inequality rows (build_ub_rhs) and at most time_limit seconds for this run
+    rows = np.arange(N_UB_ROWS, dtype=np.int32)
+    h.changeRowsBounds(N_UB_ROWS, rows, np.full(N_UB_ROWS, -highspy.kHighsInf), ub_rhs)
+    # the HiGHS time limit counts the run time of the instance since it was created
+    h.setOptionValue("time_limit", h.getRunTime() + time_limit)
+    return run_highs(h)
+
+
+### solve the allocation LP for every point of a parameter sweep ###
+def parametric_sweep(v_icu, v_noicu, status, base, points, warm_start=True, backend=None, **solver_options):
+    # base: values of all the SWEEP_PARAMS, points: list of dicts overriding some of them
+    # yields (params, result) where result is a scipy OptimizeResult, like linprog's
+    # the constraint matrices are built once, each point only patches the waitlist
+    # column of the objective and the right-hand side of the inequality rows
+    # backend: None solves the LP relaxation (warm-started), otherwise every point is
+    # handed to solver.solve_allocation, e.g. backend="milp" for integral allocations
+    v_icu = np.asarray(v_icu, dtype=float)
+    model = build_model(v_icu, v_noicu, status, **base)
+    waitlist_cols = np.arange(len(v_icu)) * N_UNITS + WAITLIST
+    ub_rows = np.arange(len(model["b_ub"]), dtype=np.int32)
+    h = None
+    if backend is None and warm_start and highspy is not None:
+        h = highs_from_model(model)
+        waitlist_cols = waitlist_cols.astype(np.int32)
+
+    for point in points:
+        params = dict(base, **point)
+        model["c"][waitlist_cols] = -waitlist_factor(params["wl_len"], params["WL_step"], params["ew"]) * v_icu
+        model["b_ub"] = build_ub_rhs(params["R_icu"], params["R_noicu"], params["Umax"],
+                                     params["wl_len"], params["WL_step"])
+        if backend is not None:
+            result = solve_allocation(model, backend, **solver_options)
+        elif h is None:
+            result = solve_allocation(model, "linprog")
+        else:
+            h.changeColsCost(len(waitlist_cols), waitlist_cols, model["c"][waitlist_cols])
+            h.changeRowsBounds(len(ub_rows), ub_rows, np.full(len(ub_rows), -highspy.kHighsInf), model["b_ub"])
+            result = run_highs(h)
+        yield params, result
@@ -0,0 +1,146 @@
+import argparse
+import os
+
+import numpy as np
+
+from patient_values import sofa_mortality_table
+
+# Synthetic census and history files shaped like the output of query_updated.sql on MIMIC-IV,
+# one JSON record per (patient, diagnosis) line, ORDER BY subject_id, icd_diagnose,
+# diagnose_priority, with every value a string like the exported query results:
+#   incoming.json / existing.json (input of process.py):
+#     subject_id, admit_day, age, icd_diagnose, diagnose_priority, sofa, allocation_result
+#   historical.json (input of historical_stat_process.py):
+#     subject_id, age, icd_diagnose, diagnose_priority, dead_flag, death_time, sofa, allocation_result
+# The shapes follow MIMIC-IV hosp.diagnoses_icd and the first-day SOFA of icu.icustays:
+# ~25k distinct ICD-9 / ICD-10 codes with a heavy-tailed (Zipf) frequency, about 13 diagnoses
+# per admission (seq_num 1..39), a right-skewed SOFA that is higher in ICU, anchor_age 18..91.
+
+N_CODES = 25000
+ZIPF_EXPONENT = 1.1
+MEAN_DIAGNOSES = 13
+MAX_DIAGNOSES = 39
+# share of the ICU patients among the incoming, existing and historical patients
+ICU_SHARE = {"incoming": 0.15, "existing": 0.12, "history": 0.2}
+# mean first-day SOFA; inpatients are mostly without a score, which the query turns into 1
+MEAN_SOFA_ICU = 5.5
+MEAN_SOFA_INPATIENT = 1.5
+ADMIT_DAY = "2190-12-11"
+CHUNK = 10000
+
+
+### ICD codes in the styles of MIMIC-IV: ICD-9 (4019, V1254, E8497) and ICD-10 (I10, E785, Z87891) ###
+def icd_vocabulary(n_codes=N_CODES, seed=0):
+    rng = np.random.default_rng(seed)
+    codes = set()
+    while len(codes) < n_codes:
+        kind = rng.random()
+        if kind < 0.4:
+            code = "%d" % rng.integers(10, 100000)
+        elif kind < 0.5:
+            code = "%s%d" % ("VE"[rng.integers(0, 2)], rng.integers(10, 10000))
+        else:
+            code = "%s%02d%s" % (chr(65 + rng.integers(0, 26)), rng.integers(0, 100),
+                                 "" if rng.random() < 0.1 else str(rng.integers(0, 10000)))
+        codes.add(code)
+    return np.array(sorted(codes))
+
+
+def code_weights(n_codes, exponent=ZIPF_EXPONENT, seed=0):
+    # frequency of the code of rank r is proportional to r^-exponent, ranks shuffled over the codes
+    weights = np.arange(1, n_codes + 1, dtype=float) ** -exponent
+    np.random.default_rng(seed).shuffle(weights)
+    return weights / weights.sum()
+
+
+### the records of a chunk of patients, in query order ###
+def _patient_records(rng, sids, codes, weights, icu_share):
+    n = len(sids)
+    n_diag = np.clip(1 + rng.negative_binomial(3, 3 / (3 + MEAN_DIAGNOSES - 1), n), 1, MAX_DIAGNOSES)
+    icu = rng.random(n) < icu_share
+    sofa = np.clip(rng.negative_binomial(2, 2 / (2 + np.where(icu, MEAN_SOFA_ICU, MEAN_SOFA_INPATIENT))), 0, 24)
+    age = np.clip(rng.normal(63, 17, n).round(), 18, 91).astype(int)
+    patient = np.repeat(np.arange(n), n_diag)
+    diagnoses = rng.choice(len(codes), size=len(patient), p=weights)
+    starts = np.concatenate([[0], np.cumsum(n_diag)[:-1]])
+    priority = np.arange(len(patient)) - np.repeat(starts, n_diag) + 1
+    # codes are sorted, so the code index orders icd_diagnose like the query
+    order = np.lexsort((priority, diagnoses, patient))
+    return {
+        "sid": sids,
+        "icu": icu,
+        "sofa": sofa,
+        "age": age,
+        "patient": patient[order],
+        "code": codes[diagnoses[order]],
+        "priority": priority[order],
+    }
+
+
+def _write_records(path, n_patients, kind, first_sid, seed, codes, weights):
+    rng = np.random.default_rng(seed)
+    mortality = sofa_mortality_table()
+    n_records = 0
+    with open(path, 'w') as f:
+        for start in range(0, n_patients, CHUNK):
+            sids = np.arange(first_sid + start, first_sid + min(start + CHUNK, n_patients))
+            chunk = _patient_records(rng, sids, codes, weights, ICU_SHARE[kind])
+            results = np.where(chunk["icu"], "ICU", "INPATIENT").tolist()
+            sids, age, sofa = sids.tolist(), chunk["age"].tolist(), chunk["sofa"].tolist()
+            # every value is a plain string without characters to escape, so the lines are
+            # formatted directly instead of through json.dumps (same output)
+            if kind == "history":
+                # deaths follow the SOFA mortality, a bit lower in ICU
+                dead = rng.random(len(sids)) < mortality[chunk["sofa"]] * np.where(chunk["icu"], 0.8, 1.0)
+                tails = ['"dead_flag": "1", "death_time": "2191-01-02 00:00:00"' if d
+                         else '"dead_flag": "0", "death_time": null' for d in dead]
+                line = ('{"subject_id": "%d", "age": "%d", "icd_diagnose": "%s", "diagnose_priority": "%d", %s, '
+                        '"sofa": "%d", "allocation_result": "%s"}')
+                lines = [line % (sids[p], age[p], code, priority, tails[p], sofa[p], results[p])
+                         for p, code, priority in zip(chunk["patient"].tolist(), chunk["code"].tolist(),
+                                                      chunk["priority"].tolist())]
+            else:
+                line = ('{"subject_id": "%d", "admit_day": "' + ADMIT_DAY + '", "age": "%d", "icd_diagnose": "%s", '
+                        '"diagnose_priority": "%d", "sofa": "%d", "allocation_result": "%s"}')
+                lines = [line % (sids[p], age[p], code, priority, sofa[p], results[p])
+                         for p, code, priority in zip(chunk["patient"].tolist(), chunk["code"].tolist(),
+                                                      chunk["priority"].tolist())]
+            f.write('\n'.join(lines) + '\n')
+            n_records += len(lines)
+    return n_records
+
+
+### write incoming.json / existing.json of a census day ###
+def write_census(directory, n_incoming, n_existing, seed=0, n_codes=N_CODES):
+    codes = icd_vocabulary(n_codes, seed)
+    weights = code_weights(n_codes, seed=seed)
+    os.makedirs(directory, exist_ok=True)
+    # existing patients first, subject ids do not overlap
+    return (_write_records(os.path.join(directory, "incoming.json"), n_incoming, "incoming",
+                           10000000 + n_existing, seed + 1, codes, weights),
+            _write_records(os.path.join(directory, "existing.json"), n_existing, "existing",
+                           10000000, seed + 2, codes, weights))
+
+
+### write historical.json ###
+def write_history(path, n_patients, seed=0, n_codes=N_CODES):
+    codes = icd_vocabulary(n_codes, seed)
+    weights = code_weights(n_codes, seed=seed)
+    return _write_records(path, n_patients, "history", 10000000, seed + 3, codes, weights)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default="EP_SYN", help="output directory of incoming.json / existing.json")
+    parser.add_argument("--incoming", type=int, default=100)
+    parser.add_argument("--existing", type=int, default=600)
+    parser.add_argument("--history", type=int, default=100000, help="patients of historical.json, 0 for none")
+    parser.add_argument("--history-path", default="historical.json")
+    parser.add_argument("--codes", type=int, default=N_CODES, help="number of distinct ICD codes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    n_in, n_ex = write_census(args.dir, args.incoming, args.existing, args.seed, args.codes)
+    print("census records: %d incoming, %d existing" % (n_in, n_ex))
+    if args.history:
+        print("history records: %d" % write_history(args.history_path, args.history, args.seed, args.codes))